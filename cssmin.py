@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+# Simple css minifier and url rewriter used when combining stylesheets.
+#
+# The minifier only does what is safe without parsing css: comments are
+# removed (except /*! ... */ ones, usually licenses), runs of whitespace are
+# collapsed and whitespace around { } ; , > and after : is dropped.  Strings
+# are left untouched.
+
+import os
+import re
+
+# Bump whenever a change could alter the output, cached output keyed on the
+# old version is then discarded.
+VERSION = '1'
+
+_STRING = r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''
+
+_COMMENT_RE = re.compile(r'(%s)|(/\*.*?\*/)|(\s+)' % _STRING, re.S)
+_PUNCT_RE   = re.compile(r'(%s)|(\s*;+\s*\})\s*|\s*([{};,>])\s*|(:)\s+| {2,}' % _STRING)
+
+_URL_RE    = re.compile(r'url\(\s*([\'"]?)(.*?)\1\s*\)', re.I)
+_IMPORT_RE = re.compile(r'(@import\s+)([\'"])(.*?)\2', re.I)
+
+def cssmin(css):
+    """minify the given css source."""
+    def stripComment(m):
+        if m.group(1):                  # string
+            return m.group(1)
+        if m.group(2):                  # comment
+            if m.group(2).startswith('/*!'):
+                return m.group(2)
+            return ''
+        return ' '                      # whitespace
+
+    def stripSpace(m):
+        if m.group(1):                  # string
+            return m.group(1)
+        if m.group(2):                  # trailing semicolons of a block
+            return '}'
+        if m.group(3):                  # punctuation
+            return m.group(3)
+        if m.group(4):                  # colon
+            return ':'
+        return ' '
+
+    css = _COMMENT_RE.sub(stripComment, css)
+    css = _PUNCT_RE.sub(stripSpace, css)
+    return css.strip()
+
+def isRelativeUrl(url):
+    """return true if url is relative to the stylesheet it appears in."""
+    return not (url == '' or url.startswith('/') or url.startswith('#') or
+                re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', url))
+
+def rewriteUrls(css, srcFname, targetFname):
+    """rewrite the relative url() and @import references in css, which was
+       loaded from srcFname, so they still point at the same files when the
+       css is served from targetFname.
+    """
+    src_dir = os.path.dirname(srcFname)
+    target_dir = os.path.dirname(targetFname) or os.curdir
+
+    def rewrite(url):
+        if not isRelativeUrl(url):
+            return url
+        suffix = ''
+        match = re.search(r'[?#]', url)
+        if match:
+            (url, suffix) = (url[:match.start()], url[match.start():])
+        path = os.path.normpath(os.path.join(src_dir, url))
+        return os.path.relpath(path, target_dir).replace('\\', '/') + suffix
+
+    def fixUrl(m):
+        return 'url(%s%s%s)' % (m.group(1), rewrite(m.group(2)), m.group(1))
+
+    def fixImport(m):
+        return '%s%s%s%s' % (m.group(1), m.group(2), rewrite(m.group(3)), m.group(2))
+
+    css = _URL_RE.sub(fixUrl, css)
+    return _IMPORT_RE.sub(fixImport, css)
+
+if __name__ == '__main__':
+    import sys
+    sys.stdout.write(cssmin(sys.stdin.read()))
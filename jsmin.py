@@ -30,12 +30,24 @@
 # SOFTWARE.
 # */
 
+import re
+import string
 from StringIO import StringIO
 
-def jsmin(js):
+# Bump whenever a change could alter minified output, cached output keyed
+# on the old version is then discarded.
+VERSION = '1'
+
+def jsmin(js, engine = 'classic'):
+    """minify the given javascript source.
+
+       engine selects the implementation: 'classic' is the character at a
+       time port of jsmin.c, 'fast' is the buffered engine.  Both produce
+       identical output.
+    """
     ins = StringIO(js)
     outs = StringIO()
-    JavascriptMinify().minify(ins, outs)
+    ENGINES[engine]().minify(ins, outs)
     str = outs.getvalue()
     if len(str) > 0 and str[0] == '\n':
         str = str[1:]
@@ -212,7 +224,240 @@ class JavascriptMinify(object):
         self._jsmin()
         self.instream.close()
 
+
+# --- Buffered engine --- #
+#
+# FastJavascriptMinify runs the same state machine as JavascriptMinify, but
+# over an in-memory buffer instead of a stream.  Control characters are
+# translated once up front, and runs that the state machine would walk one
+# character at a time (identifiers and punctuation, whitespace, comments,
+# string and regular expression literals) are consumed with compiled patterns.
+
+_CTRL_TABLE = string.maketrans(
+    ''.join([chr(i) for i in range(32)]),
+    ''.join([(i == 10 and '\n') or (i == 13 and '\n') or ' ' for i in range(32)]))
+_CTRL_UNICODE_TABLE = dict([(i, (i == 13 and u'\n') or u' ')
+                            for i in range(32) if i != 10])
+
+_PLAIN_RUN   = re.compile(r'[^ \n/\'"]+')
+_SPACE_RUN   = re.compile(r'[ \n]+')
+_REGEX_BODY  = re.compile(r'[^/\\\n]*')
+_STRING_BODY = {"'": re.compile(r"[^'\\\n]*"),
+                '"': re.compile(r'[^"\\\n]*')}
+
+_REGEX_PREFIX = frozenset('(,=:[?!&|;{}\n')
+_LINE_CLOSERS = frozenset(['}', ']', ')', '+', '-', '"', '\''])
+_LINE_OPENERS = frozenset(['{', '[', '(', '+', '-'])
+
+def normalizeControlChars(js):
+    """translate control characters the way JavascriptMinify._get does:
+       carriage returns become linefeeds, everything else becomes a space.
+    """
+    if isinstance(js, unicode):
+        return js.translate(_CTRL_UNICODE_TABLE)
+    return js.translate(_CTRL_TABLE)
+
+class FastJavascriptMinify(object):
+
+    def _get(self):
+        pos = self.pos
+        if pos < self.size:
+            self.pos = pos + 1
+            return self.buf[pos]
+        return '\000'
+
+    def _peek(self):
+        if self.pos < self.size:
+            return self.buf[self.pos]
+        return '\000'
+
+    def _next(self):
+        """get the next character, excluding comments.  Comment bodies are
+           skipped with a single find() instead of a character loop.
+        """
+        c = self._get()
+        if c == '/' and self.theA != '\\':
+            p = self._peek()
+            if p == '/':
+                end = self.buf.find('\n', self.pos + 1)
+                if end == -1:
+                    self.pos = self.size
+                    return '\000'
+                self.pos = end + 1
+                return '\n'
+            if p == '*':
+                end = self.buf.find('*/', self.pos + 1)
+                if end == -1:
+                    raise UnterminatedComment()
+                self.pos = end + 2
+                return ' '
+        return c
+
+    def _literal(self, body, terminator, error):
+        """copy a string or regular expression literal whose opening
+           delimiter has already been written.  Leaves the position just past
+           the closing delimiter, which is not written.
+        """
+        buf = self.buf
+        out = self.out
+        while 1:
+            m = body.match(buf, self.pos)
+            out(m.group())
+            pos = m.end()
+            if pos >= self.size:
+                raise error()
+            c = buf[pos]
+            if c == terminator:
+                self.pos = pos + 1
+                return
+            if c == '\n' or pos + 1 >= self.size:
+                raise error()
+            out(buf[pos:pos + 2])
+            self.pos = pos + 2
+
+    def _action(self, action):
+        """see JavascriptMinify._action."""
+        if action <= 1:
+            self.out(self.theA)
+
+        if action <= 2:
+            self.theA = self.theB
+            if self.theA == "'" or self.theA == '"':
+                self.out(self.theA)
+                self._literal(_STRING_BODY[self.theA], self.theA,
+                              UnterminatedStringLiteral)
+
+        if action <= 3:
+            self.theB = self._next()
+            if self.theB == '/' and self.theA in _REGEX_PREFIX:
+                self.out(self.theA)
+                self.out(self.theB)
+                self._literal(_REGEX_BODY, '/', UnterminatedRegularExpression)
+                self.theA = '/'
+                self.theB = self._next()
+
+    def _jsmin(self):
+        """see JavascriptMinify._jsmin.  Before taking a single step the loop
+           checks whether the next steps are a run it can take all at once.
+        """
+        self.theA = '\n'
+        self._action(3)
+
+        buf = self.buf
+        out = self.out
+        while self.theA != '\000':
+            a = self.theA
+            b = self.theB
+
+            # Whitespace after whitespace, or after a character that never
+            # needs a separator: every step just drops B.
+            if b == ' ' or b == '\n':
+                if a == ' ' or a == '\n':
+                    m = _SPACE_RUN.match(buf, self.pos)
+                    if m is not None:
+                        run = m.group()
+                        if a == '\n' or b == '\n' or '\n' in run[:-1]:
+                            self.theA = '\n'
+                        self.theB = run[-1]
+                        self.pos = m.end()
+                elif not isAlphanum(a) and a not in _LINE_CLOSERS:
+                    m = _SPACE_RUN.match(buf, self.pos)
+                    if m is not None:
+                        self.theB = m.group()[-1]
+                        self.pos = m.end()
+
+            # Plain characters after a non-whitespace character: every step
+            # outputs A and shifts, so copy the whole run.
+            elif (a != ' ' and a != '\n' and b != '/' and b != '\000' and
+                  b != '"' and b != "'"):
+                m = _PLAIN_RUN.match(buf, self.pos)
+                if m is not None:
+                    seq = b + m.group()
+                    k = len(seq) - 1
+                    out(a)
+                    out(seq[:k - 1])
+                    self.theA = seq[k - 1]
+                    self.theB = seq[k]
+                    self.pos = m.end()
+
+            a = self.theA
+            b = self.theB
+            if a == ' ':
+                if isAlphanum(b):
+                    self._action(1)
+                else:
+                    self._action(2)
+            elif a == '\n':
+                if b in _LINE_OPENERS:
+                    self._action(1)
+                elif b == ' ':
+                    self._action(3)
+                else:
+                    if isAlphanum(b):
+                        self._action(1)
+                    else:
+                        self._action(2)
+            else:
+                if b == ' ':
+                    if isAlphanum(a):
+                        self._action(1)
+                    else:
+                        self._action(3)
+                elif b == '\n':
+                    if a in _LINE_CLOSERS:
+                        self._action(1)
+                    else:
+                        if isAlphanum(a):
+                            self._action(1)
+                        else:
+                            self._action(3)
+                else:
+                    self._action(1)
+
+    def minify(self, instream, outstream):
+        self.buf = normalizeControlChars(instream.read())
+        self.size = len(self.buf)
+        self.pos = 0
+        chunks = []
+        self.out = chunks.append
+        self.theA = '\n'
+        self.theB = None
+
+        self._jsmin()
+        instream.close()
+        outstream.write(''.join(chunks))
+
+
+ENGINES = {'classic' : JavascriptMinify,
+           'fast'    : FastJavascriptMinify}
+
+
+def compareEngines(fnames):
+    """minify each file with every engine, report files whose outputs differ
+       and the throughput of each engine in MB/s.  Returns the number of
+       mismatched files.
+    """
+    import time
+    sources = [open(fname, 'r').read() for fname in fnames]
+    total_mb = sum([len(src) for src in sources]) / (1024.0 * 1024.0)
+    mismatches = 0
+    results = {}
+    for engine in sorted(ENGINES):
+        start = time.time()
+        results[engine] = [jsmin(src, engine) for src in sources]
+        elapsed = max(time.time() - start, 1e-6)
+        print "%-8s %8.3f MB in %7.3fs  %8.2f MB/s" % (engine, total_mb, elapsed,
+                                                     total_mb / elapsed)
+    for (i, fname) in enumerate(fnames):
+        if results['fast'][i] != results['classic'][i]:
+            print "MISMATCH: %s" % fname
+            mismatches += 1
+    return mismatches
+
+
 if __name__ == '__main__':
     import sys
+    if len(sys.argv) > 2 and sys.argv[1] == '--compare':
+        sys.exit(compareEngines(sys.argv[2:]) and 1 or 0)
     jsm = JavascriptMinify()
     jsm.minify(sys.stdin, sys.stdout)
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+#
+# Benchmarks for p5_packager.
+#
+# Generates a synthetic project of the requested size and times each phase
+# of a build on it separately.  Results are written as JSON so runs can be
+# compared across commits, --baseline fails the run if a phase got slower
+# than a previous result by more than --threshold.
+#
+#   p5_benchmark.py --packages 20 --files 50 -o new.json --baseline old.json
+
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import p5_packager
+pj = os.path.join
+
+VERSION = 1
+
+# Phases in the order they are run and reported
+PHASES = ["load_config", "load_config_plan", "match_files", "match_files_warm",
+          "compress_js_1", "compress_js_2", "copy", "subst",
+          "full_build", "noop_build"]
+
+BUILD_KEY = "bench"
+
+
+def main():
+   options = parseOptions()
+   params = {"packages"    : options.packages,
+             "ref_depth"   : options.ref_depth,
+             "files"       : options.files,
+             "js_size"     : options.js_size,
+             "seed"        : options.seed}
+
+   work_dir = tempfile.mkdtemp(prefix = "p5_benchmark")
+   try:
+      project_dir = pj(work_dir, "project")
+      print "Generating project in %s" % project_dir
+      generateProject(project_dir, options.packages, options.ref_depth, options.files,
+                      options.js_size, options.seed)
+      results = runBenchmarks(project_dir, options.runs)
+   finally:
+      if options.keep:
+         print "Kept %s" % work_dir
+      else:
+         shutil.rmtree(work_dir)
+
+   report = {"version"  : VERSION,
+             "time"     : time.time(),
+             "python"   : platform.python_version(),
+             "platform" : platform.platform(),
+             "params"   : params,
+             "runs"     : options.runs,
+             "results"  : results}
+   printResults(results)
+
+   if options.output:
+      open(options.output, 'w').write(json.dumps(report, sort_keys = True, indent = 1))
+      print "Wrote %s" % options.output
+
+   if options.baseline:
+      baseline = json.loads(open(options.baseline, 'r').read())
+      regressions = compareResults(baseline, report, options.threshold, options.min_delta)
+      if regressions:
+         raise SystemExit("%d phase(s) slower than %s by more than %d%%" %
+                          (len(regressions), options.baseline, options.threshold * 100))
+
+
+def parseOptions():
+   parser = optparse.OptionParser(usage = "usage: %prog [options]")
+   parser.add_option("--packages", type = "int", default = 10,
+               help = "Number of packages. [%default]")
+   parser.add_option("--ref-depth", type = "int", default = 3,
+               help = "Length of the chain of configs that ref each other, each one "
+                      "adds a root of its own. [%default]")
+   parser.add_option("--files", type = "int", default = 20,
+               help = "Number of js files per root. [%default]")
+   parser.add_option("--js-size", type = "int", default = 4096,
+               help = "Approximate size of each js file in bytes. [%default]")
+   parser.add_option("--seed", type = "int", default = 1,
+               help = "Random seed of the generated content. [%default]")
+   parser.add_option("--runs", type = "int", default = 3,
+               help = "Number of times each phase is timed, the fastest counts. [%default]")
+   parser.add_option("-o", "--output", default = None,
+               help = "File to write the JSON results to.")
+   parser.add_option("--baseline", default = None,
+               help = "JSON results of an earlier run to compare against.")
+   parser.add_option("--threshold", type = "float", default = 0.1,
+               help = "Fraction a phase may be slower than the baseline before it "
+                      "counts as a regression. [%default]")
+   parser.add_option("--min-delta", type = "float", default = 0.005,
+               help = "Seconds a phase has to be slower by at least to count as a "
+                      "regression, so noise in very quick phases is ignored. [%default]")
+   parser.add_option("--keep", action = "store_true", default = False,
+               help = "Don't remove the generated project.")
+   (options, args) = parser.parse_args()
+   if args:
+      parser.error("no arguments expected")
+   return options
+
+
+def generateProject(projectDir, packages = 10, refDepth = 3, files = 20, jsSize = 4096,
+                    seed = 1):
+   """
+   Write a synthetic project to projectDir (build.cfg and its sources).
+
+   Each package has a chain of refDepth configs, c0 <- c1 <- ... where every
+   config adds a root of files js files and a css file.  The "bench" build uses
+   the last config of the chain.  A final package holds the subst files.
+   """
+   rand = random.Random(seed)
+   os.makedirs(projectDir)
+
+   package_cfgs = []
+   for pkg_num in range(packages):
+      pkg_key = "pkg%03d" % pkg_num
+      pkg_cfg = {"id" : pkg_key}
+      for depth in range(refDepth):
+         root = "%s/c%d" % (pkg_key, depth)
+         os.makedirs(pj(projectDir, root))
+         for file_num in range(files):
+            open(pj(projectDir, root, "f%03d.js" % file_num), 'w').write(
+               generateJs(rand, jsSize))
+         open(pj(projectDir, root, "style.css"), 'w').write(generateCss(rand, root))
+
+         cfg_key = "c%d" % depth
+         if depth == refDepth - 1:
+            cfg_key = BUILD_KEY
+         cfg = {"js_files"  : [{"root" : root, "pattern" : "*.js"}],
+                "css_files" : [{"root" : root, "pattern" : "*.css"}]}
+         if depth > 0:
+            cfg["ref"] = "c%d" % (depth - 1)
+         pkg_cfg[cfg_key] = cfg
+      package_cfgs.append(pkg_cfg)
+
+   open(pj(projectDir, "index.html"), 'w').write(
+      "<html><head>\n{% css_files %}\n{% js_files %}\n</head>\n"
+      "<body><!-- {% datetime %} --></body></html>\n")
+   open(pj(projectDir, "cache.manifest"), 'w').write(
+      "CACHE MANIFEST\n# {% datetime %}\n{% cache_files %}\n")
+   package_cfgs.append({"id" : "app",
+                        BUILD_KEY : {"subst_files" : ["index.html", "cache.manifest"]}})
+
+   config = {"project"  : "benchmark",
+             "packages" : package_cfgs,
+             "builds"   : {BUILD_KEY : {"target_dir" : "out",
+                                        "js_compression" : {"level" : 2,
+                                                            "filename" : "app.min.js",
+                                                            "cache_dir" : None}}}}
+   open(pj(projectDir, "build.cfg"), 'w').write(json.dumps(config, indent = 1))
+
+   # Date the directories back, listings of just changed ones are not trusted
+   # so no project plan would be saved for them
+   old_time = time.time() - 60
+   for (dir_name, dirnames, filenames) in os.walk(projectDir):
+      os.utime(dir_name, (old_time, old_time))
+
+def generateJs(rand, size):
+   """ Return about size bytes of javascript with the usual comments and strings. """
+   parts = []
+   total = 0
+   while total < size:
+      name = "fn%d" % rand.randint(0, 1 << 30)
+      part = ("/**\n * %s does things.\n * @param value  what to use\n */\n"
+              "function %s(value, other) {\n"
+              "   var result = value + %d;   // offset\n"
+              "   if (result > other) {\n"
+              "      return \"%s: \" + result;\n"
+              "   }\n"
+              "   return [result, other, 'x' + value].join(\",\");\n"
+              "}\n\n" % (name, name, rand.randint(0, 1000), name))
+      parts.append(part)
+      total += len(part)
+   return "".join(parts)
+
+def generateCss(rand, root):
+   return ("/* %s */\n.a%d {\n   color : #%06x;\n   background: url(\"img/bg.png\");\n}\n"
+           % (root, rand.randint(0, 1000), rand.randint(0, 0xffffff)))
+
+
+class Quiet(object):
+   """ Swallows the output of the packager while it is being timed. """
+   def write(self, data):
+      pass
+
+   def flush(self):
+      pass
+
+def timeRuns(func, runs, setup = None):
+   """ Return the times of runs calls of func, calling setup (untimed) before each. """
+   times = []
+   for i in range(runs):
+      if setup is not None:
+         setup()
+      old_stdout = sys.stdout
+      sys.stdout = Quiet()
+      try:
+         start = time.time()
+         func()
+         times.append(time.time() - start)
+      finally:
+         sys.stdout = old_stdout
+   return times
+
+def runBenchmarks(projectDir, runs):
+   """
+   Time every phase on the project in projectDir.
+   Returns map from phase name to {"min", "median", "runs"} in seconds.
+   """
+   old_cwd = os.getcwd()
+   os.chdir(projectDir)
+   try:
+      conf_file = os.path.abspath("build.cfg")
+      timings = {}
+
+      def loadProject(usePlan = False):
+         proj = p5_packager.Project()
+         proj.usePlan = usePlan
+         proj.loadConfig(conf_file)
+         return proj
+
+      timings["load_config"] = timeRuns(loadProject, runs)
+      loadProject(usePlan = True)    # Saves the plan
+      timings["load_config_plan"] = timeRuns(lambda: loadProject(usePlan = True), runs)
+
+      # Scanning with a new scanner each time, then with a warm one
+      proj = loadProject()
+      def matchFiles():
+         proj.scanner = p5_packager.DirScanner()
+         proj.updateFileGroups([BUILD_KEY])
+         proj.getMergedFileGroup(BUILD_KEY)
+      timings["match_files"] = timeRuns(matchFiles, runs)
+      def matchFilesWarm():
+         proj.updateFileGroups([BUILD_KEY])
+         proj.getMergedFileGroup(BUILD_KEY)
+      timings["match_files_warm"] = timeRuns(matchFilesWarm, runs)
+
+      grouped_files = proj.getMergedFileGroup(BUILD_KEY)
+      js_files = grouped_files["js_files"]
+      for level in (1, 2):
+         timings["compress_js_%d" % level] = timeRuns(
+            lambda: proj.compressJsFiles(level, js_files, "bench.js"), runs)
+
+      copy_jobs = []
+      for files in grouped_files.itervalues():
+         copy_jobs.extend([(fname, pj("copy_out", fname)) for fname in files])
+      removeCopies = lambda: shutil.rmtree("copy_out", True)
+      timings["copy"] = timeRuns(
+         lambda: p5_packager.FileCopier().copyFiles(copy_jobs), runs, removeCopies)
+      removeCopies()
+
+      def copySubstFiles():
+         for fname in grouped_files["subst_files"]:
+            shutil.copyfile(fname, fname + ".subst")
+      def runSubst():
+         for fname in grouped_files["subst_files"]:
+            proj.runFileSubst(fname + ".subst", grouped_files)
+      timings["subst"] = timeRuns(runSubst, runs, copySubstFiles)
+
+      # Full builds from scratch, then rebuilds with nothing to do
+      def clobber():
+         proj.lastFileGroups = {}
+         shutil.rmtree("out", True)
+         if os.path.exists("app.min.js"):
+            os.remove("app.min.js")
+      timings["full_build"] = timeRuns(lambda: proj.runBuild([BUILD_KEY]), runs, clobber)
+      timings["noop_build"] = timeRuns(lambda: proj.runBuild([BUILD_KEY]), runs)
+   finally:
+      os.chdir(old_cwd)
+
+   results = {}
+   for (phase, times) in timings.iteritems():
+      ordered = sorted(times)
+      results[phase] = {"min"    : ordered[0],
+                        "median" : ordered[len(ordered) // 2],
+                        "runs"   : times}
+   return results
+
+def printResults(results):
+   print "%-18s %10s %10s" % ("phase", "min (s)", "median (s)")
+   for phase in PHASES:
+      if results.has_key(phase):
+         print "%-18s %10.4f %10.4f" % (phase, results[phase]["min"], results[phase]["median"])
+
+def compareResults(baseline, report, threshold, minDelta = 0.0):
+   """
+   Print how each phase compares with the baseline results.  Returns the list
+   of phases that are slower by more than threshold (a fraction) and by at
+   least minDelta seconds.
+   """
+   if baseline.get("params", None) != report["params"]:
+      print "Warning: baseline was run with different parameters %s" % baseline.get("params")
+
+   regressions = []
+   print "%-18s %10s %10s %8s" % ("phase", "base (s)", "new (s)", "change")
+   for phase in PHASES:
+      base = baseline.get("results", {}).get(phase, None)
+      new  = report["results"].get(phase, None)
+      if base is None or new is None:
+         continue
+      change = 0.0
+      if base["min"] > 0:
+         change = (new["min"] - base["min"]) / base["min"]
+      flag = ""
+      if change > threshold and new["min"] - base["min"] >= minDelta:
+         flag = "  REGRESSION"
+         regressions.append(phase)
+      print "%-18s %10.4f %10.4f %+7.1f%%%s" % (phase, base["min"], new["min"],
+                                                change * 100, flag)
+   return regressions
+
+
+if __name__ == '__main__':
+   main()
@@ -4,53 +4,130 @@
 #
 # TODO:
 #
+import collections
+import contextlib
 import copy
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import filecmp
 import fnmatch
+import gzip
+import hashlib
 import json
 import math
+import mimetypes
+import multiprocessing
 import optparse
 import os
 import shutil
+import socket
+import stat
 import sys
 import re
+import select
+import struct
 import tempfile
+import threading
 import time
 import types
-import uuid
+import urllib
 import distutils.util
 import string
+import StringIO
+import BaseHTTPServer
+import SocketServer
 import subprocess
 pj = os.path.join
 
+try:
+   import fcntl
+except ImportError:
+   fcntl = None      # Not on windows, no reflinks there
+
+try:
+   from os import scandir
+except ImportError:
+   try:
+      from scandir import scandir    # Optional backport, speeds up scans on python 2
+   except ImportError:
+      scandir = None
+
+try:
+   import brotli                     # Optional, adds .br precompressed files
+except ImportError:
+   brotli = None
+
 
 def main():
    options = parseOptions()
 
+   # Hand plain builds and clobbers to a running daemon, it has everything loaded
+   socket_path = options.socket or DaemonClient.socketPath(options.config_file)
+   daemon_only = options.stop_daemon or options.daemon_status
+   if daemon_only or not (options.daemon or options.no_daemon or options.profile or
+                          options.monitor or options.serve):
+      command = "build"
+      if options.stop_daemon:
+         command = "stop"
+      elif options.daemon_status:
+         command = "status"
+      elif options.clobber:
+         command = "clobber"
+      status = DaemonClient(socket_path).run({"command"          : command,
+                                              "build"            : options.build,
+                                              "workers"          : options.workers,
+                                              "build_workers"    : options.build_workers,
+                                              "change_detection" : options.change_detection,
+                                              "cache_dir"        : options.cache_dir,
+                                              "config_file"      : options.config_file,
+                                              "cwd"              : os.getcwd()})
+      if status is not None:
+         sys.exit(status)
+      if daemon_only:
+         raise SystemExit("No daemon running on %s" % socket_path)
+
    # Do stuff
    proj = Project()
+   proj.jsWorkers = options.workers
+   proj.buildWorkers = options.build_workers
+   proj.changeDetection = options.change_detection
+   proj.cacheDir = options.cache_dir
+   proj.usePlan = not options.no_plan
+   if options.profile:
+      proj.profiler.record    = True
+      proj.profiler.traceFile = options.profile
    proj.loadConfig(options.config_file)
 
-   all_build_ids = [build.key for build in proj.builds]
+   if options.daemon:
+      BuildDaemon(proj, socket_path).serve()
+      return
 
-   # If the user did not specify a build target, or specified the default all
-   # target, then only use builds that are not hidden. Otherwise only build the
-   # specified build.
-   builds_ids = []
-   if options.build == "all":
-      build_ids = [build.key for build in proj.builds if not build.hidden]
-   else:
-      assert options.build in all_build_ids, "Invalid build specified"
-      build_ids = [options.build]
+   try:
+      build_ids = proj.getBuildIds(options.build)
+   except ValueError, e:
+      raise SystemExit(e)
 
    if options.clobber:
       proj.clobber(build_ids)
+   elif options.serve:
+      if len(build_ids) != 1:
+         raise SystemExit("--serve needs a single build, pick one with -b")
+      server = DevServer(proj, build_ids[0], options.host, options.port)
+      server.run(int(options.interval), poll = options.poll)
    elif options.monitor:
-      proj.runMonitoredBuild(build_ids, int(options.interval))
+      proj.runMonitoredBuild(build_ids, int(options.interval), poll = options.poll,
+                             debounce = options.debounce)
    else:
       proj.runBuild(build_ids)
       print "Done"
 
+   if options.profile:
+      print proj.profiler.summary()
+      print proj.statCache.summary()
+      proj.profiler.writeTrace()
+
 
 def parseOptions():
    usage = "usage: %prog [options] config_file" + \
@@ -63,6 +140,50 @@ def parseOptions():
                help = "If true, then monitor the files and update dynamically")
    parser.add_option("--interval", type = "int", default = 1,
                help = "Number of seconds to wait between checks for build changes. [%default]")
+   parser.add_option("--debounce", type = "float", default = 0.1,
+               help = "When monitoring, wait until nothing changed for this many seconds "
+                      "before rebuilding. [%default]")
+   parser.add_option("--poll", action="store_true", default = False,
+               help = "When monitoring, poll every interval instead of waiting for "
+                      "change notifications (inotify).")
+   parser.add_option("--serve", action="store_true", default = False,
+               help = "Serve the build over http from memory instead of writing it, "
+                      "rebuilding on changes and reloading open pages.")
+   parser.add_option("--host", default = "127.0.0.1",
+               help = "Address to serve on. [%default]")
+   parser.add_option("--port", type = "int", default = 8000,
+               help = "Port to serve on. [%default]")
+   parser.add_option("--daemon", action="store_true", default = False,
+               help = "Keep the project loaded and run builds sent to the socket. "
+                      "Later builds and clobbers are handed to it.")
+   parser.add_option("--no-daemon", action="store_true", default = False,
+               help = "Build here even if a daemon is running.")
+   parser.add_option("--stop-daemon", action="store_true", default = False,
+               help = "Stop the daemon of the config file.")
+   parser.add_option("--daemon-status", action="store_true", default = False,
+               help = "Show what the daemon of the config file is doing.")
+   parser.add_option("--socket", default = None,
+               help = "Socket of the daemon. [.<config file>.p5_daemon next to it]")
+   parser.add_option("--no-plan", action="store_true", default = False,
+               help = "Don't use or save the project plan, a snapshot of the config "
+                      "and the files it matched (.<config file>.p5_plan next to it).")
+   parser.add_option("--cache-dir", default = os.environ.get("P5_CACHE_DIR", None),
+               help = "Directory of the minify cache, can be shared between machines "
+                      "(an NFS mount).  Overrides the build settings. [$P5_CACHE_DIR]")
+   parser.add_option("--build-workers", type = "int", default = 0,
+               help = "Number of builds to run at the same time, 0 for all of them. [%default]")
+   parser.add_option("-j", "--workers", type = "int", default = None,
+               help = "Number of processes to minify js files with, 0 for one per cpu. "
+                      "Overrides the build setting, --serve always uses one.")
+   parser.add_option("--change-detection", choices = ["mtime", "hash"], default = None,
+               help = "How to tell if a source changed since the last build: 'mtime' "
+                      "(size and mtime) or 'hash' (content hash when the mtime differs, "
+                      "for fresh checkouts).  Overrides the build setting.")
+   parser.add_option("--profile", default = None, metavar = "TRACE_FILE",
+               help = "Time the phases of the build, print a summary and write them "
+                      "to TRACE_FILE as a Chrome trace (chrome://tracing).  With "
+                      "--monitor each rebuild goes to its own file, numbered from 0 "
+                      "for the first build (trace.0.json, trace.1.json, ...).")
    parser.add_option("--clobber", action="store_true", default = False,
                help = "Clean up the build area by removing the target directories.")
 
@@ -74,6 +195,8 @@ def parseOptions():
 
    fname = os.path.abspath(args[0])
    options.config_file = fname
+   if options.cache_dir:
+      options.cache_dir = os.path.abspath(os.path.expanduser(options.cache_dir))
 
    if not os.path.exists(fname):
       print "File does not exist: ", fname
@@ -93,6 +216,23 @@ class Project(object):
       self.builds     = []
       self.rawConfig  = None
       self.confFile   = ""
+      self.jsWorkers  = None   # If set, overrides Build.jsWorkers
+      self.buildWorkers = 0    # Number of builds run at once, 0 for all of them
+      self.changeDetection = None  # If set, overrides Build.changeDetection
+      self.cacheDir   = None   # If set, overrides Build.jsCacheDir and cssCacheDir
+      self.usePlan    = True   # Load from and save to the ProjectPlan
+      self.statCache  = StatCache()
+      self.scanner    = DirScanner(self.statCache)
+      self.profiler   = Profiler()
+
+      # Map from subst tag name to function(fileMap) returning its text
+      self.substTags      = dict(DEFAULT_SUBST_TAGS)
+      self.substTemplates = {}   # Map from subst file to (mtime, size, SubstTemplate)
+
+      # Map from build key to the merged file groups of its last build, used
+      # to tell what an incremental build needs to redo.
+      self.lastFileGroups = {}
+      self.lastJsChunks   = {}   # Map from build key to {chunk file: js files}
 
    # --- Configuration Related ---- #
    def getPackage(self, key):
@@ -107,35 +247,99 @@ class Project(object):
             return build
       return None
 
+   def getBuildIds(self, buildName):
+      """
+      Return the keys of the builds to run for buildName.  "all" is every build
+      that is not hidden, otherwise it has to be the key of a build.
+      """
+      if buildName == "all":
+         return [build.key for build in self.builds if not build.hidden]
+      if self.getBuild(buildName) is None:
+         raise ValueError("Invalid build specified: %s" % buildName)
+      return [buildName]
+
    def loadConfig(self, confFile):
-      """ Load configuration file and process it into settings. """
+      """
+      Load configuration file and process it into settings.  If the project
+      plan saved last time is still valid its file matches are used instead of
+      scanning (and its config instead of reading a JSON config file).
+      """
       self.confFile = confFile
 
       try:
-         namespace = {}
-         execfile(self.confFile, namespace)
-         if not namespace.has_key("config"):
-            self.rawConfig = json.loads(open(self.confFile, 'r').read())
-         else:
-            self.rawConfig = namespace["config"]
+         with self.profiler.span("load_config"):
+            plan  = None
+            saved = None
+            if self.usePlan:
+               plan  = ProjectPlan(confFile)
+               saved = plan.load(self.statCache)
+            if saved is not None and saved[0]:
+               (is_json, self.rawConfig) = (True, saved[1])
+            else:
+               (is_json, self.rawConfig) = self.readConfigFile()
+
+            if saved is not None and saved[0] == is_json and saved[1] == self.rawConfig:
+               self.config(saved[2])
+            elif plan is not None:
+               raw_config = copy.deepcopy(self.rawConfig)   # config() changes it
+               matches = self.config()
+               plan.save(is_json, raw_config, matches,
+                         self.scanner.dirMtimes(set([m[0] for m in matches])))
+            else:
+               self.config()
       except ValueError, e:
          raise SystemExit(e)
 
-      self.config()
+   def readConfigFile(self):
+      """
+      Return (is json, raw config) read from confFile, which is either JSON or
+      python code setting config.
+      """
+      try:
+         return (True, json.loads(open(self.confFile, 'r').read()))
+      except ValueError:
+         pass
+      namespace = {}
+      execfile(self.confFile, namespace)
+      if not namespace.has_key("config"):
+         raise ValueError("%s is not JSON and does not set config" % self.confFile)
+      return (False, namespace["config"])
+
+   def config(self, matches = None):
+      """
+      Set up the packages and builds from rawConfig and find their files.
 
-   def config(self):
+      @param matches: Optional file matches to use instead of scanning (see
+                      updateFileGroups).
+      @returns: The file matches.
+      """
       # Clear the old settings (if any)
       self.packages = []
       self.builds   = []
+      self.lastFileGroups = {}
+      self.lastJsChunks   = {}
 
       self.name = self.rawConfig.get("project", "")
 
+      # Extra subst tags, values are a string or a function(fileMap) (python configs)
+      for (tag_name, tag_value) in self.rawConfig.get("subst_tags", {}).iteritems():
+         if callable(tag_value):
+            self.registerSubstTag(tag_name, tag_value)
+         else:
+            self.registerSubstTag(tag_name, lambda fileMap, value = tag_value: value)
+
       # build up packages
       package_configs = self.rawConfig.get("packages", [])
-      for pkg_cfg in package_configs:
+      ids = set([pkg_cfg.get("id", None) for pkg_cfg in package_configs])
+      for (index, pkg_cfg) in enumerate(package_configs):
          key = pkg_cfg.get("id", None)
          if key is None:
-            key = str(uuid.uuid4())
+            # Named after where it is in the list, so it stays the same from
+            # run to run (split builds name their chunks with it)
+            key = "package%d" % index
+            while key in ids:
+               key = "_" + key
+            ids.add(key)
          pkg = Package(key)
          pkg.config(pkg_cfg)
          self.packages.append(pkg)
@@ -147,6 +351,64 @@ class Project(object):
          build.config(build_cfg)
          self.builds.append(build)
 
+      return self.updateFileGroups(matches = matches)
+
+   def updateFileGroups(self, buildIds = None, matches = None):
+      """
+      Update the file lists of all file groups used by the given builds (default
+      all of them).  Every root directory is scanned once for all the patterns
+      used with it.
+
+      @param matches: Optional map from (root, pattern) to the files it matches
+                      to use instead of scanning, as returned by DirScanner.scan.
+      @returns: The matches used.
+      """
+      # Collect the groups along with the groups they extend, many configs
+      # share the same group objects
+      file_groups = {}
+      for pkg in self.packages:
+         for (cfg_key, cfg) in pkg.configs.iteritems():
+            if buildIds is None or cfg_key in buildIds:
+               for fg in cfg.fileGroups.itervalues():
+                  while fg is not None and not file_groups.has_key(id(fg)):
+                     file_groups[id(fg)] = fg
+                     fg = fg.parent
+
+      if matches is None:
+         span = self.profiler.start("update_file_groups")
+         matchers = []
+         for fg in file_groups.itervalues():
+            matchers.extend([m for m in fg.matchers if not isinstance(m, types.StringTypes)])
+         matches = self.scanner.scan(matchers)
+         span.stop(files = sum([len(files) for files in matches.itervalues()]))
+
+      # File lists are worked out from the scan when they are next used
+      for fg in file_groups.itervalues():
+         fg.invalidate(matches)
+      return matches
+
+   def registerSubstTag(self, name, func):
+      """
+      Add a tag that subst files can use as {% name %}.
+
+      @param func: function(fileMap) returning the text to put in place of the tag
+                   (or None to leave the tag alone).  fileMap is the map from file
+                   group key to files of the build.  It is called once per build.
+
+      note: during a build the datetime and build_id tags are not volatile, they
+            come from the build's inputs (see BuildManifest.identity).
+      """
+      self.substTags[name] = func
+
+   def getSubstTemplate(self, fname):
+      """ Return the parsed SubstTemplate for fname, reparsing only if it changed. """
+      stats  = self.statCache.stat(fname)
+      cached = self.substTemplates.get(fname, None)
+      if cached is None or cached[0] != stats.st_mtime or cached[1] != stats.st_size:
+         cached = (stats.st_mtime, stats.st_size, SubstTemplate(open(fname, 'r').read()))
+         self.substTemplates[fname] = cached
+      return cached[2]
+
    #{ Processing Related
    def clobber(self, buildIds):
       """
@@ -162,118 +424,459 @@ class Project(object):
             print "removing: %s" % target_dir
             shutil.rmtree(target_dir)
 
-   def runBuild(self, buildIds):
+   def runBuild(self, buildIds, changedFiles = None, cancelled = None):
       """
       Run a build and put it into place
+
+      @param changedFiles: Optional set of the source files (as named in the file
+                  groups) that changed since the last build.  If given, we trust it
+                  instead of checking every file: only those files are copied, the
+                  js is only recompressed if one of its inputs changed, and subst
+                  files are only redone if they or the file lists changed.
+                  None runs a full build.
+      @param cancelled: Optional function checked between the steps of the build.
+                  If it returns True the build is stopped by raising BuildCancelled,
+                  and the next build redoes changedFiles.
+
+      Up to buildWorkers builds run at once.  Builds that write the same target
+      dir or make different compressed files of the same name take turns.  Work
+      that builds have in common (compressing the same files, precompressing the
+      same data) is only done once (see SharedWork).  Each file is only stat'ed
+      once in all of them (see StatCache).  Builds minifying js with a pool of
+      processes run one at a time, forking from threads can hang the child.
+      While builds run at once, their output goes through BuildOutput so lines
+      don't get mixed up.
       """
+      shared = SharedWork()
+
+      def runBuilds(buildKeys):
+         for buildKey in buildKeys:
+            if isinstance(sys.stdout, BuildOutput):
+               sys.stdout.setPrefix("[%s] " % buildKey)
+            last_state = (self.lastFileGroups.get(buildKey, None),
+                          self.lastJsChunks.get(buildKey, None))
+            try:
+               with self.profiler.span("build", build = buildKey):
+                  self.runBuildTarget(buildKey, changedFiles, cancelled, shared)
+            except BuildCancelled:
+               # Put back the state of the last complete build, so the next
+               # incremental build works out what to do from there
+               for (last_map, last_value) in zip((self.lastFileGroups, self.lastJsChunks),
+                                                 last_state):
+                  if last_value is None:
+                     last_map.pop(buildKey, None)
+                  else:
+                     last_map[buildKey] = last_value
+               print "Build cancelled: %s" % buildKey
+               raise
+
+      with self.statCache.cycle():
+         if (self.buildWorkers == 1 or len(buildIds) <= 1 or
+             self.usesJsProcesses(buildIds)):
+            runBuilds(buildIds)
+         else:
+            groups = self.groupConflictingBuilds(buildIds)
+            old_stdout = sys.stdout
+            sys.stdout = BuildOutput(old_stdout)
+            try:
+               runThreaded(runBuilds, groups, self.buildWorkers or len(groups))
+            finally:
+               sys.stdout.flush()
+               sys.stdout = old_stdout
+
+   def usesJsProcesses(self, buildIds):
+      """ Return True if any of buildIds minifies js with more than one process. """
       for buildKey in buildIds:
-         print "Running build: %s" % buildKey
+         build_config = self.getBuild(buildKey)
+         if build_config is None or build_config.compressJsLevel <= 0:
+            continue
+         workers = build_config.jsWorkers
+         if self.jsWorkers is not None:
+            workers = self.jsWorkers
+         if workers == 0:
+            workers = multiprocessing.cpu_count()
+         if workers > 1:
+            return True
+      return False
 
+   def groupConflictingBuilds(self, buildIds):
+      """
+      Split buildIds into groups that can be built at the same time, builds
+      in a group have to run one after the other.  Builds conflict if they
+      have the same target dir, or make compressed files of the same name
+      from different inputs.
+      """
+      groups   = []
+      group_of = {}   # Map from build key to its group
+      writers  = {}   # Map from output to list of (work key, build key) making it
+      for buildKey in buildIds:
          build_config = self.getBuild(buildKey)
          if build_config is None:
             raise RuntimeError("No config found for build")
+         # Working out the file lists here also means the builds only read them
          grouped_files = self.getMergedFileGroup(buildKey)
-         target_dir    = build_config.targetDir
-
-         # If we are compressing the javascript files, then compress them in
-         # place if the files have changed and replace them in the subst map
+         outputs = [(os.path.abspath(build_config.targetDir), buildKey)]
          if build_config.compressJsLevel > 0:
-            src_compressed_file = build_config.compressedJsFilename
-            target_compressed_file = pj(target_dir, build_config.compressedJsFilename)
-
-            js_files_have_changed = False
-            js_files = grouped_files['js_files']
-            # If any source file is newer than the last compressed version, we need to rebuild
-            for fname in js_files:
-               if self.fileHasChanged(fname, src_compressed_file,
-                                      compareSize = False, compareTime = True):
-                  print "%s has changed. Regen compressed file" % fname
-                  js_files_have_changed = True
-                  break
+            for (fname, js_files) in self.getJsChunks(buildKey, grouped_files):
+               outputs.append((os.path.abspath(fname),
+                               (build_config.compressJsLevel, build_config.jsminEngine,
+                                tuple(js_files))))
+         if build_config.compressCssLevel > 0:
+            outputs.append((os.path.abspath(build_config.compressedCssFilename),
+                            (build_config.compressCssLevel,
+                             tuple(grouped_files.get("css_files", [])))))
+
+         group = [buildKey]
+         groups.append(group)
+         group_of[buildKey] = group
+         for (output, work_key) in outputs:
+            for (other_work_key, other_build) in writers.setdefault(output, []):
+               other_group = group_of[other_build]
+               if other_work_key != work_key and other_group is not group:
+                  # Merge into the earlier group
+                  other_group.extend(group)
+                  groups.remove(group)
+                  for key in group:
+                     group_of[key] = other_group
+                  group = other_group
+            writers[output].append((work_key, buildKey))
+      return groups
+
+   def runBuildTarget(self, buildKey, changedFiles = None, cancelled = None, shared = None):
+      """ Run the build of buildKey. (see runBuild) """
+      if shared is None:
+         shared = SharedWork()
+      print "Running build: %s" % buildKey
+
+      build_config = self.getBuild(buildKey)
+      if build_config is None:
+         raise RuntimeError("No config found for build")
+      grouped_files = self.getMergedFileGroup(buildKey)
+      target_dir    = build_config.targetDir
+
+      change_detection = build_config.changeDetection
+      if self.changeDetection is not None:
+         change_detection = self.changeDetection
+      manifest = BuildManifest(target_dir, useHash = (change_detection == "hash"),
+                               statCache = self.statCache)
+
+      last_grouped_files = self.lastFileGroups.get(buildKey, None)
+      self.lastFileGroups[buildKey] = copy.deepcopy(grouped_files)
+
+      def checkpoint():
+         if cancelled is not None and cancelled():
+            raise BuildCancelled(buildKey)
+
+      incremental = (changedFiles is not None) and (last_grouped_files is not None)
+      if incremental:
+         lists_changed = (grouped_files != last_grouped_files)
+         last_files = set()
+         for files in last_grouped_files.itervalues():
+            last_files.update(files)
+         # Copy what changed along with anything newly added to a file group
+         copy_files = set(changedFiles)
+         for files in grouped_files.itervalues():
+            copy_files.update([f for f in files if f not in last_files])
+
+      # Incremental builds pass what changed, full builds check the manifest
+      changed_files = None
+      if incremental:
+         changed_files = changedFiles
+
+      # If we are compressing the javascript files, then compress them in
+      # place if the files have changed and replace them in the subst map.
+      # Split builds do that for each chunk (package) on its own.
+      if build_config.compressJsLevel > 0:
+         chunks = self.getJsChunks(buildKey, grouped_files)
+         last_chunks = self.lastJsChunks.get(buildKey, {})
+         self.lastJsChunks[buildKey] = dict(chunks)
+
+         cache = self.getMinifyCache(build_config.jsCacheDir, build_config.jsCacheMaxBytes)
+         workers = build_config.jsWorkers
+         if self.jsWorkers is not None:
+            workers = self.jsWorkers
+
+         for (src_compressed_file, js_files) in chunks:
+            js_state = {"level" : build_config.compressJsLevel, "files" : js_files}
 
             # If they have changed, then we need to build a compressed file
-            if js_files_have_changed:
-               self.compressJsFiles(build_config.compressJsLevel, js_files, src_compressed_file)
-            grouped_files["js_files"] = [src_compressed_file]
-
-
-         # Copy files
-         # - special handling for subst files because we will regen them every time
-         for (fg_key, files) in grouped_files.iteritems():
-            is_subst_files = (fg_key == 'subst_files')
-            for fname in files:
-               target_fname = pj(target_dir, fname)
-               if self.fileHasChanged(fname, target_fname) or is_subst_files:
+            if self.compressedInputsChanged("js", js_state, js_files, src_compressed_file,
+                                            manifest, changed_files,
+                                            last_chunks.get(src_compressed_file, None)):
+               def compress():
+                  span = self.profiler.start("compress_js", output = src_compressed_file)
+                  self.compressJsFiles(build_config.compressJsLevel, js_files,
+                                       src_compressed_file, jsminEngine = build_config.jsminEngine,
+                                       cache = cache, workers = workers, checkpoint = checkpoint)
+                  span.stop(files = len(js_files), bytes = os.path.getsize(src_compressed_file))
+                  return fileHash(src_compressed_file)
+               (output_hash, computed) = shared.run(
+                  ("js", os.path.abspath(src_compressed_file), build_config.compressJsLevel,
+                   build_config.jsminEngine, tuple(js_files)), compress)
+               if incremental:
+                  copy_files.add(src_compressed_file)
+               self.recordCompressedInputs("js", js_state, js_files, src_compressed_file,
+                                           manifest, output_hash)
+         self.forgetCompressedFiles("js", [c[0] for c in chunks], manifest)
+         grouped_files["js_files"] = [c[0] for c in chunks]
+
+      # Same for css, combined into a single stylesheet
+      if build_config.compressCssLevel > 0:
+         src_compressed_css = build_config.compressedCssFilename
+         css_files = grouped_files.get('css_files', [])
+         css_state = {"level" : build_config.compressCssLevel, "files" : css_files,
+                      "filename" : src_compressed_css}
+
+         last_css_files = None
+         if incremental:
+            last_css_files = last_grouped_files.get('css_files', [])
+         if self.compressedInputsChanged("css", css_state, css_files, src_compressed_css,
+                                         manifest, changed_files, last_css_files):
+            cache = self.getMinifyCache(build_config.cssCacheDir,
+                                        build_config.cssCacheMaxBytes)
+            def compress():
+               span = self.profiler.start("compress_css", output = src_compressed_css)
+               self.compressCssFiles(build_config.compressCssLevel, css_files,
+                                     src_compressed_css, cache = cache, checkpoint = checkpoint)
+               span.stop(files = len(css_files), bytes = os.path.getsize(src_compressed_css))
+               return fileHash(src_compressed_css)
+            (output_hash, computed) = shared.run(
+               ("css", os.path.abspath(src_compressed_css), build_config.compressCssLevel,
+                tuple(css_files)), compress)
+            if incremental:
+               copy_files.add(src_compressed_css)
+            self.recordCompressedInputs("css", css_state, css_files, src_compressed_css,
+                                        manifest, output_hash)
+         self.forgetCompressedFiles("css", [src_compressed_css], manifest)
+         grouped_files["css_files"] = [src_compressed_css]
+
+      # Work out fingerprinted output names for js and css files
+      # - a change to fingerprinting means every target name may change
+      output_names  = {}   # Map from source to output name where they differ
+      output_hashes = {}   # Map from fingerprinted source to its content hash
+      if manifest.state.get("fingerprint", 0) != build_config.fingerprintLength:
+         manifest.sections.pop("files", None)
+         manifest.state["fingerprint"] = build_config.fingerprintLength
+      if build_config.fingerprintLength:
+         for fg_key in ("js_files", "css_files"):
+            for fname in grouped_files.get(fg_key, []):
+               digest = manifest.knownOutputHash(fname, "files") or fileHash(fname)
+               output_hashes[fname] = digest
+               output_names[fname]  = fingerprintName(fname, digest,
+                                                      build_config.fingerprintLength)
+
+      # Subst files show the output names and the build identity, so an
+      # incremental build redoes them if either changed as well
+      last_output_names = manifest.state.get("output_names", None)
+      manifest.state["output_names"] = output_names
+      identity = None
+      if grouped_files.get("subst_files", None):
+         last_identity = manifest.state.get("identity", None)
+         all_files = []
+         for files in grouped_files.itervalues():
+            all_files.extend(files)
+         identity = manifest.identity(all_files)
+      if incremental:
+         redo_subst = (lists_changed or output_names != last_output_names or
+                       (identity is not None and
+                        (last_identity is None or identity[1] != last_identity["id"])))
+
+      # Copy files
+      # - special handling for subst files because we will regen them every time
+      copy_jobs  = []    # List of (source, target) to copy
+      subst_jobs = []    # List of (source, target) to copy and subst
+      span = self.profiler.start("check_changes")
+      for (fg_key, files) in grouped_files.iteritems():
+         is_subst_files = (fg_key == 'subst_files')
+         for fname in files:
+            target_fname = pj(target_dir, output_names.get(fname, fname))
+            if incremental:
+               needs_copy = (fname in copy_files) or (is_subst_files and redo_subst)
+            else:
+               needs_copy = manifest.hasChanged(fname, "files") or is_subst_files
+            if needs_copy:
+               if is_subst_files:
+                  subst_jobs.append((fname, target_fname))
+               else:
                   print "%s ==> %s" % (fname, target_fname)
-                  if not os.path.exists(os.path.dirname(target_fname)):
-                     os.makedirs(os.path.dirname(target_fname))
-                  shutil.copy2(fname, target_fname)
+                  copy_jobs.append((fname, target_fname))
+      span.stop(files = sum([len(files) for files in grouped_files.itervalues()]))
+
+      checkpoint()
+      span = self.profiler.start("copy")
+      copier = FileCopier(build_config.copyMode, build_config.copyWorkers)
+      copier.copyFiles(copy_jobs)
+      for (fname, target_fname) in copy_jobs:
+         manifest.record(fname, "files", outputHash = output_hashes.get(fname, None))
+      if self.profiler.active():
+         span.count(bytes = sum([os.path.getsize(t) for (f, t) in copy_jobs]))
+      span.stop(files = len(copy_jobs))
+      written_outputs = [target_fname for (fname, target_fname) in copy_jobs]
+
+      # Subst files are rendered straight into the target, the tag text is the
+      # same for all of them so only work it out once.  They are only written
+      # if the result differs from what is there.
+      checkpoint()
+      span = self.profiler.start("subst")
+      if subst_jobs:
+         output_map = {}
+         for (fg_key, files) in grouped_files.iteritems():
+            output_map[fg_key] = [output_names.get(f, f) for f in files]
+         tag_values = self.renderSubstTags(output_map, self.substTags)
+         (build_time, build_id) = identity
+         tag_values["datetime"] = str(datetime.datetime.fromtimestamp(build_time))
+         tag_values["build_id"] = build_id
+      for (fname, target_fname) in subst_jobs:
+         file_contents = self.getSubstTemplate(fname).render(tag_values)
+         if writeFileIfChanged(target_fname, file_contents):
+            print "%s ==> %s (subst)" % (fname, target_fname)
+            written_outputs.append(target_fname)
+         manifest.record(fname, "files",
+                         outputHash = hashlib.sha1(file_contents).hexdigest())
+         span.count(bytes = len(file_contents))
+      span.stop(files = len(subst_jobs))
+
+      if build_config.fingerprintLength and build_config.assetManifest:
+         asset_map = {}
+         for (fname, output_name) in output_names.iteritems():
+            asset_map[fname.replace("\\", "/")] = output_name.replace("\\", "/")
+         asset_fname = pj(target_dir, build_config.assetManifest)
+         if writeFileIfChanged(asset_fname, json.dumps(asset_map, sort_keys = True, indent = 1)):
+            print "Wrote asset manifest: %s" % asset_fname
+            written_outputs.append(asset_fname)
+
+      # Precompress the outputs we wrote, or all of them if the settings changed
+      if build_config.precompress is not None:
+         precompressor = Precompressor(**build_config.precompress)
+         precompressor.shared = shared
+         if manifest.state.get("precompress", None) != precompressor.settings():
+            manifest.state["precompress"] = precompressor.settings()
+            written_outputs = []
+            for files in grouped_files.itervalues():
+               written_outputs.extend([pj(target_dir, output_names.get(f, f)) for f in files])
+            if build_config.fingerprintLength and build_config.assetManifest:
+               written_outputs.append(pj(target_dir, build_config.assetManifest))
+         span = self.profiler.start("precompress")
+         precompressor.run(written_outputs)
+         span.stop(files = len(written_outputs))
+      else:
+         manifest.state.pop("precompress", None)
 
-                  # Check for subst
-                  if is_subst_files:
-                     self.runFileSubst(target_fname, grouped_files)
+      with self.profiler.span("save_manifest"):
+         manifest.save()
    #}
 
-   def runMonitoredBuild(self, buildIds, interval):
+   def getMinifyCache(self, cacheDir, maxBytes):
       """
-      Run indefinitely checking build.
+      Return the MinifyCache for a build's cache settings, or None if it has
+      none.  A relative cacheDir is relative to the config file, so the cache
+      is the same one whatever directory we run from.
       """
-      last_file_details = {}   # Map from file to mod_timeList of tuples of (file, mod_time)
-      last_conf_details = None # Tuple of file and mod_time
+      cache_dir = self.cacheDir or cacheDir
+      if not cache_dir:
+         return None
+      cache_dir = os.path.expanduser(cache_dir)
+      if not os.path.isabs(cache_dir):
+         cache_dir = pj(os.path.dirname(os.path.abspath(self.confFile)), cache_dir)
+      return MinifyCache(cache_dir, maxBytes)
 
-      while True:
-         # -- CHECK FOR CONF FILE CHANGES --- #
-         # if there are changes, reload the file
-         new_conf_details = os.stat(self.confFile).st_mtime
-         if new_conf_details != last_conf_details:
-            last_conf_details = new_conf_details
-            print "Changed conf detected, reloading..."
-            self.loadConfig(self.confFile)
-
-         # -- UPDATE ALL THE FILE GROUPS -- #
-         # this catches any newly matched file names
-         for pkg in self.packages:
-            for buildKey in buildIds:
-               cfg = pkg.getConfig(buildKey)
-               if cfg is not None:
-                  for fg in cfg.fileGroups.values():
-                     fg.update()
-
-         # Get full file list and all unique directories
-         # - we monitor all of these for changes
-         new_file_details = {}
+   @staticmethod
+   def compressedInputsChanged(kind, state, srcFiles, compressedFname, manifest,
+                               changedFiles = None, lastFiles = None):
+      """
+      Return True if the combined file compressedFname needs to be made again
+      from srcFiles.
+
+      @param kind: "js" or "css", the manifest state and sections to use.
+      @param state: The settings it is made with, a change to them means a rebuild.
+      @param changedFiles, lastFiles: Set for incremental builds, the changed files
+                           and what srcFiles was last time (None if unknown).
+                           Otherwise the manifest tells us what changed.
+      """
+      if not manifest.stats.exists(compressedFname):
+         return True
+      if changedFiles is not None:
+         if srcFiles != lastFiles:
+            return True
+         has_changed = lambda fname: fname in changedFiles
+      else:
+         # Rebuild if the inputs or settings are not what the last compressed
+         # version was made from, or the compressed file itself was changed
+         last_states = manifest.state.get("%s_compression" % kind, {})
+         if (last_states.get(compressedFname, None) != state or
+             manifest.hasChanged(compressedFname, "outputs")):
+            return True
+         has_changed = lambda fname: manifest.hasChanged(fname, "%s_inputs" % kind)
+
+      for fname in srcFiles:
+         if has_changed(fname):
+            print "%s has changed. Regen compressed file" % fname
+            return True
+      return False
 
-         for buildKey in buildIds:
-            file_list = self.getFullFileList(buildKey)
-            for fname in file_list:
-               file_dir = os.path.dirname(fname)
-               if file_dir == "":  # handle special case of local directory
-                  file_dir = "."
-               if os.path.exists(file_dir):
-                  if not new_file_details.has_key(file_dir):
-                     new_file_details[file_dir] = os.stat(file_dir).st_mtime
-               if not new_file_details.has_key(fname):
-                  new_file_details[fname] = os.stat(fname).st_mtime
-
-         # -- CHECK FOR CHANGES --- #
-         if last_file_details != new_file_details:
-            if len(last_file_details) != len(new_file_details):
-               sym_diff = set(last_file_details.keys()).symmetric_difference(set(new_file_details.keys()))
-               print "Found files changed [%s]..." % list(sym_diff)
-
-            # Find the changes
-            for (fname, mtime) in new_file_details.iteritems():
-               old_time = last_file_details.get(fname, None)
-               if (old_time != None) and (mtime != old_time):
-                  print "file changed: ", fname
-
-            last_file_details = new_file_details
-            self.runBuild(buildIds)
-            print "---- RE-BUILD DONE ---"
+   @staticmethod
+   def recordCompressedInputs(kind, state, srcFiles, compressedFname, manifest,
+                              outputHash = None):
+      """ Record in the manifest what compressedFname was just made from. """
+      manifest.refresh(compressedFname)
+      manifest.state.setdefault("%s_compression" % kind, {})[compressedFname] = state
+      for fname in srcFiles:
+         manifest.record(fname, "%s_inputs" % kind)
+      manifest.record(compressedFname, "outputs",
+                      outputHash = outputHash or fileHash(compressedFname))
 
-         # Wait
-         time.sleep(interval)
+   @staticmethod
+   def forgetCompressedFiles(kind, compressedFnames, manifest):
+      """ Drop the manifest state of compressed files no longer made. """
+      states = manifest.state.get("%s_compression" % kind, {})
+      for fname in states.keys():
+         if fname not in compressedFnames:
+            del states[fname]
+
+   def runMonitoredBuild(self, buildIds, interval, poll = False, debounce = 0.1):
+      """
+      Run indefinitely checking build.
+      (see RebuildScheduler for the parameters)
 
+      A build that changes made out of date before it finished is cancelled, and
+      the next one covers its changes as well.
+      """
+      scheduler = RebuildScheduler(self, buildIds, interval, poll, debounce)
+      stats = self.statCache
+      last_counts = (stats.hits, stats.misses)
+      for (number, changed_files) in enumerate(scheduler.changes()):
+         # Each rebuild gets its own trace file, so writing it costs the same
+         # however long we have been running
+         rebuild_spans = []
+         if self.profiler.record:
+            self.profiler.addHook(rebuild_spans.append)
+         span = self.profiler.start("rebuild")
+         try:
+            self.runBuild(buildIds, changed_files, cancelled = scheduler.isStale)
+         except BuildCancelled:
+            span.stop(cancelled = 1)
+            scheduler.requeue(changed_files)
+            print "---- RE-BUILD CANCELLED ---"
+         else:
+            span.stop(files = len(changed_files or ()))
+            print "---- RE-BUILD DONE ---"
+         finally:
+            if self.profiler.record:
+               self.profiler.removeHook(rebuild_spans.append)
+         if self.profiler.record:
+            print "Rebuild took %.3fs (%.3fs cpu), %d stat cache hits, %d misses" % (
+               span.wallTime, span.cpuTime, stats.hits - last_counts[0],
+               stats.misses - last_counts[1])
+            self.profiler.writeTrace(self.profiler.numberedTraceFile(number), rebuild_spans)
+         last_counts = (stats.hits, stats.misses)
+
+   def watchChanges(self, buildIds, interval, poll = False):
+      """
+      Generator yielding every time the files of the given builds change, with
+      the set of changed files, or None at startup and after the configuration
+      was reloaded.  It waits for the next change when resumed.
+      """
+      return RebuildScheduler(self, buildIds, interval, poll).changes()
 
    def getMergedFileGroup(self, buildKey):
       """
@@ -289,6 +892,89 @@ class Project(object):
 
       return file_map
 
+   def getJsChunks(self, buildKey, groupedFiles):
+      """
+      Return the list of (compressed file, js files) chunks of a split build, in
+      package order so each chunk comes after the ones it depends on.  Packages
+      not named in a chunk get one of their own.  Builds that are not split have
+      a single chunk of all the js files in groupedFiles.
+      """
+      build_config = self.getBuild(buildKey)
+      if not build_config.jsChunks:
+         return [(build_config.compressedJsFilename, groupedFiles.get('js_files', []))]
+
+      chunk_defs = []
+      if isinstance(build_config.jsChunks, list):
+         chunk_defs = build_config.jsChunks
+      chunk_of_pkg = {}
+      for chunk_def in chunk_defs:
+         for pkg_key in chunk_def.get("packages", []):
+            chunk_of_pkg[pkg_key] = chunk_def
+
+      (root, ext) = os.path.splitext(build_config.compressedJsFilename)
+      chunks = []
+      chunk_files = {}
+      for pkg in self.packages:
+         cfg = pkg.getConfig(buildKey)
+         if cfg is None or not cfg.fileGroups.has_key("js_files"):
+            continue
+         chunk_def = chunk_of_pkg.get(pkg.key, {"name" : pkg.key})
+         chunk_name = chunk_def.get("name", pkg.key)
+         fname = chunk_def.get("filename", "%s.%s%s" % (root, chunk_name, ext))
+         if not chunk_files.has_key(fname):
+            chunk_files[fname] = []
+            chunks.append((fname, chunk_files[fname]))
+         chunk_files[fname].extend(cfg.fileGroups["js_files"].files)
+
+      return [(fname, files) for (fname, files) in chunks if files]
+
+   def getCompressedOutputs(self, buildIds):
+      """
+      Return the set of absolute paths of the compressed js and css files the
+      given builds make before copying them to their target dirs.
+      """
+      outputs = set()
+      for buildKey in buildIds:
+         build_config = self.getBuild(buildKey)
+         if build_config.compressJsLevel > 0:
+            grouped_files = self.getMergedFileGroup(buildKey)
+            for (fname, js_files) in self.getJsChunks(buildKey, grouped_files):
+               outputs.add(os.path.abspath(fname))
+         if build_config.compressCssLevel > 0:
+            outputs.add(os.path.abspath(build_config.compressedCssFilename))
+      return outputs
+
+   def getWatchDirs(self, buildIds):
+      """
+      Return the set of directories to watch to see every change to the files
+      of the given builds, and to the configuration file.  Target directories are
+      left out so the build does not trigger itself.
+      """
+      target_dirs = set()
+      for buildKey in buildIds:
+         target_dirs.add(os.path.abspath(self.getBuild(buildKey).targetDir))
+
+      watch_dirs = set([os.path.dirname(os.path.abspath(self.confFile))])
+      roots = set()
+      for pkg in self.packages:
+         for buildKey in buildIds:
+            cfg = pkg.getConfig(buildKey)
+            if cfg is not None:
+               for fg in cfg.fileGroups.values():
+                  for matcher in fg.getMatchers():
+                     if isinstance(matcher, types.StringTypes):
+                        watch_dirs.add(os.path.abspath(os.path.dirname(matcher)))
+                     else:
+                        roots.add(matcher[0])
+
+      for root_dir in roots:
+         for dir_name in self.scanner.walkDirs(root_dir):
+            dir_name = os.path.abspath(dir_name)
+            if not [t for t in target_dirs if dir_name == t or dir_name.startswith(t + os.sep)]:
+               watch_dirs.add(dir_name)
+
+      return watch_dirs
+
    def getFullFileList(self, buildKey):
       file_list = []
       file_map = self.getMergedFileGroup(buildKey)
@@ -325,45 +1011,34 @@ class Project(object):
       @param fileMap: Map from file key to list of files of that key.
       """
       print "Running subst on file: ", fname
-      file_contents = open(fname, 'r').read()
-
-      # Find CSS items
-      css_files = fileMap.get("css_files", None)
-      if css_files:
-         css_contents = "<!-- CSS Files -->\n"
-         for css_file in css_files:
-            css_file = css_file.replace("\\", "/")
-            css_contents += '<link rel="stylesheet" href="%s" type="text/css"/>\n' % css_file
-
-         file_contents = re.sub("{%\s*?css_files\s*?%}", css_contents, file_contents)
-
-      # Find JS items
-      js_files = fileMap.get("js_files", None)
-      if js_files:
-         js_contents = "<!-- JS Files -->\n"
-         for js_file in js_files:
-            js_file = js_file.replace("\\", "/")
-            js_contents += '<script type="text/javascript" src="%s"></script>\n' % js_file
-
-         file_contents = re.sub("{%\s*?js_files\s*?%}", js_contents, file_contents)
-
-      # Find Cache Related Items
-      file_contents = re.sub("{%\s*?datetime\s*?%}", str(datetime.datetime.now()), file_contents )
-
-      all_files_list = ""
-      for (fg_key, files) in fileMap.iteritems():
-         for file_path in files:
-            file_path = os.path.normpath(file_path)
-            file_path = file_path.replace("\\", "/")
-            all_files_list += "%s\n" % file_path
-      file_contents = re.sub("{%\s*?cache_files\s*?%}", all_files_list, file_contents)
+      template = SubstTemplate(open(fname, 'r').read())
+      file_contents = template.render(Project.renderSubstTags(fileMap))
 
       # Write out the file
       open(fname, 'w').write(file_contents)
 
+   @staticmethod
+   def renderSubstTags(fileMap, substTags = None):
+      """
+      Return map from tag name to the text it is replaced with for the given
+      file map.  Tags whose function returns None are left out.
+
+      @param substTags: Map from tag name to function(fileMap), default the
+                        built in tags.
+      """
+      if substTags is None:
+         substTags = DEFAULT_SUBST_TAGS
+      tag_values = {}
+      for (tag_name, tag_func) in substTags.iteritems():
+         value = tag_func(fileMap)
+         if value is not None:
+            tag_values[tag_name] = str(value)
+      return tag_values
+
 
    @staticmethod
-   def compressJsFiles(compressionLevel, jsFileList, targetFname):
+   def compressJsFiles(compressionLevel, jsFileList, targetFname, jsminEngine = "fast",
+                       cache = None, workers = 1, checkpoint = None):
       """
       @param compressionLevel: amount of compression to use.
                               0 - no compression
@@ -373,33 +1048,385 @@ class Project(object):
                               4 - super magic (potentially change code)
       @param jsFileList: A list of js files that should be combined and compressed.
       @param targetFname: The destination file for the compression.
+      @param jsminEngine: jsmin implementation used for level 2 ("fast" or "classic").
+      @param cache: Optional MinifyCache, only files whose content changed get
+                    minified.
+      @param workers: Number of processes to minify files with (0 for one per cpu).
+      @param checkpoint: Optional function called as the output is written, it can
+                         raise to stop (the target is then left alone).
+
+      note: each file is minified on its own and the results are joined with a
+            newline just like the sources are, so statements never run together
+            across a file boundary and automatic semicolon insertion sees the same
+            line breaks it would in the combined source.
       """
-      combined_data = ""
-      for js_file in jsFileList:
-         combined_data += open(js_file, 'r').read()
-         combined_data += "\n"
+      # Stream the output into a temp file next to the target and move it
+      # into place once complete, so we never hold the whole bundle in memory
+      # and readers never see a partially written file.
+      (fd, tmp_fname) = makeTempFile(targetFname)
+      out_file = os.fdopen(fd, 'wb')
+      chunks = Project.iterCompressedJs(compressionLevel, jsFileList, jsminEngine, cache,
+                                        workers)
+      try:
+         for chunk in chunks:
+            out_file.write(chunk)
+            if checkpoint is not None:
+               checkpoint()
+         out_file.close()
+
+         # Leave the old file (and its mtime) alone if nothing changed
+         if os.path.exists(targetFname) and filecmp.cmp(tmp_fname, targetFname, shallow = False):
+            print "Compressed js unchanged: %s" % targetFname
+            os.remove(tmp_fname)
+         else:
+            replaceFile(tmp_fname, targetFname)
+      except CacheEntryDamaged:
+         # The cached output was removed, make it again from the pieces
+         out_file.close()
+         os.remove(tmp_fname)
+         Project.compressJsFiles(compressionLevel, jsFileList, targetFname, jsminEngine,
+                                 cache, workers, checkpoint)
+      except:
+         chunks.close()      # Stops the minify workers
+         out_file.close()
+         os.remove(tmp_fname)
+         raise
 
+   @staticmethod
+   def iterCompressedJs(compressionLevel, jsFileList, jsminEngine = "fast", cache = None,
+                        workers = 1):
+      """
+      Generator yielding the compressed output of jsFileList a piece at a time.
+      (see compressJsFiles for the parameters)
+
+      At most one source file per worker is held in memory at once.
+      """
       # Clamp compression to the largest amount we have available
       if compressionLevel > 3:
-         compressed_data = 3
+         compressionLevel = 3
+
+      if workers == 0:
+         workers = multiprocessing.cpu_count()
+
+      if compressionLevel < 2:
+         for js_file in jsFileList:
+            in_file = open(js_file, 'r')
+            try:
+               for chunk in iter(lambda: in_file.read(COPY_CHUNK_SIZE), ""):
+                  yield chunk
+            finally:
+               in_file.close()
+            yield "\n"
+         return
+
+      version = Project.minifierVersion(compressionLevel)
+      keys    = [None] * len(jsFileList)
+      bundle  = None
+      if cache is not None:
+         for (i, js_file) in enumerate(jsFileList):
+            keys[i] = cache.makeKey(open(js_file, 'r').read(), compressionLevel, version)
+
+         # The whole output is cached as well, under a key made of all the inputs
+         bundle_key = cache.makeKey("\n".join(keys), compressionLevel, "bundle:" + version)
+         cached = cache.openEntry(bundle_key)
+         if cached is not None:
+            print "Compressed js from cache: %d files" % len(jsFileList)
+            try:
+               for chunk in iter(lambda: cached.read(COPY_CHUNK_SIZE), ""):
+                  yield chunk
+            finally:
+               cached.close()
+            return
+         bundle = cache.startEntry(bundle_key)
+
+      # Find the files the cache can't give us, those are the only ones we minify
+      misses = []
+      for (i, js_file) in enumerate(jsFileList):
+         if cache is None or not cache.has(keys[i]):
+            print "Minifying: %s" % js_file
+            misses.append(i)
+
+      minified = Project.iterMinifiedJsFiles(compressionLevel, [jsFileList[i] for i in misses],
+                                             jsminEngine, version, workers)
+      misses  = set(misses)
+      changed = False     # A file was edited since we made the keys
+      try:
+         for (i, js_file) in enumerate(jsFileList):
+            if i in misses:
+               (key, fragment) = minified.next()
+            else:
+               (key, fragment) = (keys[i], cache.get(keys[i]))
+               if fragment is None:    # Evicted or damaged under us, minify it here
+                  (key, fragment) = _minifyJsWorker((compressionLevel, js_file,
+                                                     jsminEngine, version))
+                  misses.add(i)
+            if cache is not None and i in misses:
+               # The worker hashes what it minified, if the file was edited
+               # since we made keys[i] its output must not go under that key
+               if key != keys[i]:
+                  print "Changed while compressing: %s" % js_file
+                  changed = True
+               else:
+                  cache.put(key, fragment)
+            if bundle is not None:
+               bundle.write(fragment + "\n")
+            yield fragment
+            yield "\n"
+         if bundle is not None and not changed:
+            bundle.commit()
+      finally:
+         minified.close()
+         if bundle is not None:
+            bundle.abort()
+
+      if cache is not None:
+         cache.prune()
 
+   @staticmethod
+   def minifyJs(compressionLevel, jsData, jsminEngine = "fast"):
+      """
+      Compress a string of javascript at the given level (see compressJsFiles).
+      """
       compressed_data = ""
       if 3 == compressionLevel:
          uglify_js_path = os.path.expanduser('~/node_modules/.bin/uglifyjs')
          if not os.path.exists(uglify_js_path):
             print "Can't find uglifyjs [%s] dropping down to jsmin." % uglify_js_path
          p = subprocess.Popen([uglify_js_path, ], stdout = subprocess.PIPE, stdin = subprocess.PIPE)
-         compressed_data = p.communicate(input=combined_data)[0]
+         compressed_data = p.communicate(input=jsData)[0]
       elif 2 == compressionLevel:
          import jsmin
-         compressed_data = jsmin.jsmin(combined_data)
+         compressed_data = jsmin.jsmin(jsData, jsminEngine)
       elif 1 == compressionLevel:
-         compressed_data = combined_data
+         compressed_data = jsData
       else:
          assert False, "Should not get here"
+      return compressed_data
+
+   @staticmethod
+   def iterMinifiedJsFiles(compressionLevel, jsFileList, jsminEngine, version, workers = 1):
+      """
+      Generator minifying each file in jsFileList independently, using a pool of
+      workers processes when there is more than one.  Yields (cache key, minified
+      data) in the same order as jsFileList.
+      """
+      work = [(compressionLevel, js_file, jsminEngine, version) for js_file in jsFileList]
+      # The workers read the files themselves, so only one per worker is in
+      # memory at a time
+      if workers <= 1 or len(work) <= 1:
+         for args in work:
+            yield _minifyJsWorker(args)
+         return
+
+      pool = multiprocessing.Pool(min(workers, len(work)))
+      try:
+         for result in pool.imap(_minifyJsWorker, work):
+            yield result
+      finally:
+         pool.terminate()
+         pool.join()
+
+   @staticmethod
+   def compressCssFiles(compressionLevel, cssFileList, targetFname, cache = None,
+                        checkpoint = None):
+      """
+      Combine css files into targetFname, rewriting relative url() and @import
+      references so they work from where targetFname is.
+
+      @param compressionLevel: 1 - put everything in 1 file
+                               2 - also strip comments and whitespace
+      @param cache: Optional MinifyCache of the processed files.
+      @param checkpoint: Optional function called as the output is written (see
+                         compressJsFiles).
+      """
+      (fd, tmp_fname) = makeTempFile(targetFname)
+      out_file = os.fdopen(fd, 'wb')
+      try:
+         for chunk in Project.iterCompressedCss(compressionLevel, cssFileList, targetFname,
+                                                cache):
+            out_file.write(chunk)
+            if checkpoint is not None:
+               checkpoint()
+         out_file.close()
+
+         if os.path.exists(targetFname) and filecmp.cmp(tmp_fname, targetFname, shallow = False):
+            print "Compressed css unchanged: %s" % targetFname
+            os.remove(tmp_fname)
+         else:
+            replaceFile(tmp_fname, targetFname)
+      except CacheEntryDamaged:
+         out_file.close()
+         os.remove(tmp_fname)
+         Project.compressCssFiles(compressionLevel, cssFileList, targetFname, cache,
+                                  checkpoint)
+      except:
+         out_file.close()
+         os.remove(tmp_fname)
+         raise
+
+   @staticmethod
+   def iterCompressedCss(compressionLevel, cssFileList, targetFname, cache = None):
+      """
+      Generator yielding the combined css a file at a time.
+      (see compressCssFiles for the parameters)
+      """
+      import cssmin
+      keys   = [None] * len(cssFileList)
+      texts  = [None] * len(cssFileList)   # What keys were made from, so it is what we cache
+      bundle = None
+      if cache is not None:
+         for (i, css_file) in enumerate(cssFileList):
+            # The result depends on where the file is and where it ends up
+            version = "cssmin-%s:%s:%s" % (cssmin.VERSION, css_file, targetFname)
+            texts[i] = open(css_file, 'r').read()
+            keys[i] = cache.makeKey(texts[i], compressionLevel, version)
+
+         bundle_key = cache.makeKey("\n".join(keys), compressionLevel,
+                                    "bundle:cssmin-%s" % cssmin.VERSION)
+         cached = cache.openEntry(bundle_key)
+         if cached is not None:
+            print "Compressed css from cache: %d files" % len(cssFileList)
+            try:
+               for chunk in iter(lambda: cached.read(COPY_CHUNK_SIZE), ""):
+                  yield chunk
+            finally:
+               cached.close()
+            return
+         bundle = cache.startEntry(bundle_key)
+
+      try:
+         for (i, css_file) in enumerate(cssFileList):
+            fragment = None
+            if cache is not None:
+               fragment = cache.get(keys[i])
+            if fragment is None:
+               text = texts[i]
+               if text is None:
+                  text = open(css_file, 'r').read()
+               fragment = cssmin.rewriteUrls(text, css_file, targetFname)
+               if compressionLevel >= 2:
+                  fragment = cssmin.cssmin(fragment)
+               if cache is not None:
+                  cache.put(keys[i], fragment)
+            texts[i] = None
+            if bundle is not None:
+               bundle.write(fragment + "\n")
+            yield fragment
+            yield "\n"
+         if bundle is not None:
+            bundle.commit()
+      finally:
+         if bundle is not None:
+            bundle.abort()
+      if cache is not None:
+         cache.prune()
+
+   @staticmethod
+   def minifierVersion(compressionLevel):
+      """
+      Return a string identifying the minifier used for the given level, so
+      cached output is thrown away when the minifier changes.
+      """
+      if 3 == compressionLevel:
+         uglify_js_path = os.path.expanduser('~/node_modules/.bin/uglifyjs')
+         if os.path.exists(uglify_js_path):
+            return "uglifyjs-%s" % os.stat(uglify_js_path).st_mtime
+         return "uglifyjs-missing"
+      import jsmin
+      return "jsmin-%s" % jsmin.VERSION
+
+
+def _minifyJsWorker(args):
+   """
+   Process pool entry point for Project.iterMinifiedJsFiles.  The key is made
+   from the same data that is minified, a file edited since the caller made
+   its key gets a different one.
+   """
+   (compression_level, js_file, jsmin_engine, version) = args
+   js_data = open(js_file, 'r').read()
+   key = MinifyCache.makeKey(js_data, compression_level, version)
+   return (key, Project.minifyJs(compression_level, js_data, jsmin_engine))
 
-      # Write out the file
-      open(targetFname, 'wb').write(compressed_data)
+
+class ProjectPlan(object):
+   """
+   Snapshot of a loaded project kept next to its config file, so the next
+   run can skip scanning for files (and reading a JSON config) if nothing
+   changed.
+
+   It holds the raw config, the files each (root, pattern) matcher matched and
+   the mtimes of the directories scanned to find them.  It stays valid while
+   the config file has the same size and mtime, we run from the same directory
+   and no file was added to, removed from or renamed in those directories.
+
+   A python config is still run every time, it could do anything, and the plan
+   only used if it gives the same config.  Configs that can't be stored as
+   JSON (functions as subst tags) get no plan.
+   """
+   VERSION = 1
+
+   def __init__(self, confFile):
+      (conf_dir, conf_name) = os.path.split(os.path.abspath(confFile))
+      self.fname     = pj(conf_dir, ".%s.p5_plan" % conf_name)
+      self.confFile  = confFile
+      self.confStats = None
+
+   def load(self, statCache):
+      """
+      Return (is json, raw config, matches) saved by the last run if they are
+      still valid, otherwise None.
+      """
+      self.confStats = statCache.lookup(self.confFile)
+      try:
+         plan = json.loads(open(self.fname, 'r').read())
+      except (IOError, ValueError):
+         return None
+      if (self.confStats is None or plan.get("version", None) != self.VERSION or
+          plan["cwd"] != os.getcwd() or
+          plan["conf"] != [self.confStats.st_size, self.confStats.st_mtime]):
+         return None
+      for (dir_name, mtime) in plan["dirs"].iteritems():
+         stats = statCache.lookup(dir_name)
+         if mtime != (stats and stats.st_mtime):
+            return None
+
+      matches = {}
+      for (root_dir, pattern, files) in plan["matches"]:
+         matches[(root_dir, pattern)] = files
+      return (plan["json"], plan["config"], matches)
+
+   def save(self, isJson, rawConfig, matches, dirMtimes):
+      """
+      Save the plan for the config as loaded (see load), unless dirMtimes is
+      None or the config can't be stored.  Returns True if it was saved.
+      """
+      if self.confStats is None or dirMtimes is None:
+         return False
+      plan = {"version" : self.VERSION,
+              "cwd"     : os.getcwd(),
+              "conf"    : [self.confStats.st_size, self.confStats.st_mtime],
+              "json"    : isJson,
+              "config"  : rawConfig,
+              "matches" : [[root_dir, pattern, files]
+                           for ((root_dir, pattern), files) in matches.iteritems()],
+              "dirs"    : dirMtimes}
+      try:
+         data = json.dumps(plan)
+      except (TypeError, ValueError):
+         return False
+
+      # Written in place, replacing the file would change the directory
+      # mtime and invalidate the plan if the config sits in a scanned root
+      try:
+         out_file = open(self.fname, 'w')
+         try:
+            out_file.write(data)
+         finally:
+            out_file.close()
+      except IOError, e:
+         print "Can't save project plan %s: %s" % (self.fname, e)
+         return False
+      return True
 
 
 class Package(object):
@@ -421,28 +1448,43 @@ class Package(object):
       """
       if configObj.has_key("id"):
          del configObj["id"]
-      processed_one = False     # Flag to warn if in infinite loop
-      rem_configs   = configObj # running list of remaining configs
-
-      # process one configuration at a time
-      # - (note: use while loop with remaining stack so we get a dep sort to handle the refs)
-      # - if we have the reference, then process it.  ("ref" points to another config
-      # - keep going until there are none left to process
-      while(len(rem_configs) > 0):
-         for (k, cfg) in copy.copy(rem_configs).items():
-            ref_key = cfg.get("ref", None)
-            if ((ref_key is None) or                # No ref key, so proc immediatley
-               (self.configs.has_key(ref_key))):    # Ref key found, so we can process
-               new_cfg_obj = Configuration(k)
-               if ref_key is not None:              # If have ref, override with copy of base obj
-                  new_cfg_obj = copy.deepcopy(self.configs.get(ref_key))
-               new_cfg_obj.config(cfg)
-               self.configs[k] = new_cfg_obj
-               del rem_configs[k]                     # Rem since we have processed it
-               processed_one = True
-
-         if not processed_one:
-            assert False, "Infinite loop in config reference in package: %s" % self.key
+
+      # Process configurations so that each one comes after the one it "ref"s,
+      # derived configurations then build on top of their (already created) base.
+      for k in self.resolveConfigOrder(configObj):
+         cfg = configObj[k]
+         new_cfg_obj = Configuration(k, self.configs.get(cfg.get("ref", None), None))
+         new_cfg_obj.config(cfg)
+         self.configs[k] = new_cfg_obj
+
+   def resolveConfigOrder(self, configObj):
+      """
+      Return the config keys in configObj ordered so every config comes after
+      the config it references with "ref".  Raises ValueError naming the chain
+      for reference cycles, or for a ref to a config that does not exist.
+      """
+      order = []
+      done  = set()
+
+      def visit(key, chain):
+         if key in done:
+            return
+         if key in chain:
+            cycle = chain[chain.index(key):] + [key]
+            raise ValueError("Config reference cycle in package %s: %s" %
+                             (self.key, " -> ".join(cycle)))
+         ref_key = configObj[key].get("ref", None)
+         if ref_key is not None:
+            if not configObj.has_key(ref_key):
+               raise ValueError("Config %s in package %s references unknown config: %s" %
+                                (key, self.key, ref_key))
+            visit(ref_key, chain + [key])
+         done.add(key)
+         order.append(key)
+
+      for key in sorted(configObj.keys()):
+         visit(key, [])
+      return order
 
 
 class Configuration(object):
@@ -450,11 +1492,18 @@ class Configuration(object):
    A configuration for a given package.
    This is a set of files and other information that should be
    used when the given configuration is run.
+
+   A configuration that refs another starts out sharing all of the base
+   configuration's file groups.  Groups it configures itself get a new
+   FileGroup that extends the base group, so nothing is copied.
    """
-   def __init__(self, key):
+   def __init__(self, key, base = None):
       self.key        = key
       self.fileGroups = {}
       self.ref        = None
+      if base is not None:
+         self.ref        = base.key
+         self.fileGroups = dict(base.fileGroups)
 
    def config(self, configObj):
       config_obj = copy.copy(configObj)
@@ -463,10 +1512,8 @@ class Configuration(object):
          del config_obj["ref"]
 
       for (group_key, group_cfg) in config_obj.iteritems():
-         # Try to get existing for case of "ref"
-         file_group = self.fileGroups.get(group_key, None)
-         if file_group is None:
-            file_group = FileGroup(group_key)
+         # Extend the existing group for case of "ref"
+         file_group = FileGroup(group_key, self.fileGroups.get(group_key, None))
          file_group.config(group_cfg)
          self.fileGroups[group_key] = file_group
 
@@ -478,22 +1525,45 @@ class FileGroup(object):
    We keep track of a list of matchers so we can easily update the list later.
    note: we don't keep the "static" files separately because there may
    be an order dependency in the configuration file and we need to keep track of that.
+
+   A group can extend a parent group (from a "ref"ed configuration).  It then
+   only holds its own matchers, and its files are the parent's files followed by
+   its own matches.  The file list is only worked out when it is first used
+   after an update.
    """
-   def __init__(self, key):
-      self.key   = key
-      self.files = []  # List of paths to files that have been found
+   def __init__(self, key, parent = None):
+      self.key    = key
+      self.parent = parent
+      self._files = []     # List of paths to files that have been found, None if stale
+      self._matches = None # Scan results to work out the file list from when stale
 
       # List of matcher items ("root dir", "pattern")
       #  OR  "file path"
       self.matchers = []
 
+   def _getFiles(self):
+      if self._files is None:
+         self.update(self._matches)
+      return self._files
+
+   def _setFiles(self, files):
+      self._files = files
+
+   files = property(_getFiles, _setFiles)
+
+   def getMatchers(self):
+      """ Return all matchers, including those inherited from the parent. """
+      if self.parent is None:
+         return list(self.matchers)
+      return self.parent.getMatchers() + self.matchers
+
    def config(self, fgConfig):
       """
       configuration should be a list of file names or root/pattern dictionaries
       for looking up a group of files.
       """
       # We only setup the matchers here, update takes care of updating
-      # the file list from those matchers
+      # the file list from those matchers (Project.updateFileGroups)
       for f_obj in fgConfig:
          # File string
          if isinstance(f_obj, types.StringTypes):
@@ -509,30 +1579,46 @@ class FileGroup(object):
          else:
             print "Invalid config in file group: %s" % self.key
 
-      # Update so we get the file list set accurately
-      self.update()
+   def invalidate(self, matches = None):
+      """
+      Mark the file list stale, it is worked out again from matches (see
+      update) the next time it is used.
+      """
+      self._files   = None
+      self._matches = matches
 
-   def update(self):
+   def update(self, matches = None):
       """
       Update the file list based on current files in the directory.
       (only changes if there is a root and pattern)
+
+      @param matches: Optional map from (root, pattern) matcher to the files it
+                      matches, as returned by DirScanner.scan.  Matchers missing
+                      from it are looked up with matchFiles.
       """
       file_list = []
+      if self.parent is not None:
+         file_list.extend(self.parent.files)
 
       for matcher in self.matchers:
          if isinstance(matcher, types.StringTypes):
             fname = os.path.normpath(matcher)
             file_list.append(fname)
+         elif matches is not None and matches.has_key(matcher):
+            file_list.extend(matches[matcher])
          else:
             (root_dir, pattern) = matcher
             file_list.extend(matchFiles(root_dir, pattern))
 
       # Now prune out duplicates
-      self.files = []
+      files = []
+      seen  = set()
       for fname in file_list:
-         if fname not in self.files:
-            self.files.append(fname)
-
+         if fname not in seen:
+            seen.add(fname)
+            files.append(fname)
+      self._files   = files
+      self._matches = None
 
 
 class Build(object):
@@ -548,38 +1634,2154 @@ class Build(object):
                           2 - jmin
                           3 - magic (uglify)
                           4 - super magic (potentially change code)
+   @ivar jsminEngine: jsmin implementation to use for level 2.
+                      "fast"    - buffered engine (default)
+                      "classic" - character at a time port of jsmin.c
+   @ivar jsCacheDir: Directory of the minification cache (see MinifyCache), it
+                     can be shared between machines.  Relative to the config
+                     file's directory.  None disables the cache.
+   @ivar jsCacheMaxBytes: Size bound of the minification cache.
+   @ivar jsWorkers: Number of processes used to minify js files (0 for one per cpu).
+   @ivar jsChunks: None to compress all js into compressedJsFilename, otherwise
+                   one compressed file is made per chunk (see Project.getJsChunks).
+                   "package" - a chunk per package (app.min.<package>.js), a
+                               package without an id is named packageN after
+                               its place in the list
+                   list      - of {"name", "packages", "filename"} chunk groups,
+                               other packages get a chunk of their own
+   @ivar changeDetection: How to tell a source changed since the last build.
+                          "mtime" - size or mtime differs (default)
+                          "hash"  - size differs, or mtime and content hash differ
+   @ivar compressCssLevel: 0 - no compression
+                           1 - put all css in 1 file
+                           2 - also strip comments and whitespace
+   @ivar compressedCssFilename: Name of the combined css file.
+   @ivar cssCacheDir, cssCacheMaxBytes: Cache of processed css files (see jsCacheDir).
+   @ivar fingerprintLength: If non zero, js and css files are written with this
+                            many characters of their content hash in the file
+                            name (app.3f9a1c.js) and the subst tags use those
+                            names, so they can be cached forever.
+   @ivar assetManifest: Name of the JSON file (in the target dir) mapping source
+                        names to fingerprinted names.
+   @ivar precompress: None, or dict of Precompressor settings (min_size, extensions,
+                      codecs, workers) to write .gz/.br files next to outputs.
+   @ivar copyMode: How files are put in the target dir (see FileCopier).
+   @ivar copyWorkers: Number of threads copying files.
    """
    def __init__(self, key):
       self.key       = key
       self.targetDir = ""
       self.hidden    = False
+      self.changeDetection = "mtime"
+      self.copyMode        = "copy"
+      self.copyWorkers     = 4
+      self.compressCssLevel      = 0
+      self.compressedCssFilename = ''
+      self.cssCacheDir           = ".p5_cache"
+      self.cssCacheMaxBytes      = 64 * 1024 * 1024
+
+      self.fingerprintLength = 0
+      self.assetManifest     = "assets.json"
+      self.precompress       = None
 
       self.compressJsLevel      = 0
       self.compressedJsFilename = ''
+      self.jsminEngine          = "fast"
+      self.jsCacheDir           = ".p5_cache"
+      self.jsCacheMaxBytes      = 64 * 1024 * 1024
+      self.jsWorkers            = 1
+      self.jsChunks             = None
 
    def config(self, buildConfig):
       self.targetDir = buildConfig.get("target_dir")
       self.hidden    = buildConfig.get("hidden", False)
+      self.changeDetection = buildConfig.get("change_detection", self.changeDetection)
+      self.copyMode        = buildConfig.get("copy_mode", self.copyMode)
+      self.copyWorkers     = buildConfig.get("copy_workers", self.copyWorkers)
+
+      css_compression = buildConfig.get("css_compression", None)
+      if css_compression is not None:
+         self.compressCssLevel      = css_compression.get("level", self.compressCssLevel)
+         self.compressedCssFilename = css_compression.get("filename", 'compressed_app.css')
+         self.cssCacheDir           = css_compression.get("cache_dir", self.cssCacheDir)
+         if css_compression.has_key("cache_max_mb"):
+            self.cssCacheMaxBytes = int(css_compression["cache_max_mb"] * 1024 * 1024)
+
+      # "fingerprint": true or {"length": 8, "manifest": "assets.json"}
+      fingerprint = buildConfig.get("fingerprint", False)
+      if fingerprint is True:
+         fingerprint = {}
+      if isinstance(fingerprint, dict):
+         self.fingerprintLength = fingerprint.get("length", 8)
+         self.assetManifest     = fingerprint.get("manifest", self.assetManifest)
+
+      # "precompress": true or {"min_size": 1024, "codecs": ["gzip", "br"], ...}
+      precompress = buildConfig.get("precompress", False)
+      if precompress is True:
+         precompress = {}
+      if isinstance(precompress, dict):
+         self.precompress = dict([(str(k), v) for (k, v) in precompress.iteritems()])
 
       js_compression = buildConfig.get("js_compression", None)
       if js_compression is not None:
          self.compressJsLevel      = js_compression.get("level", self.compressJsLevel)
          self.compressedJsFilename = js_compression.get("filename", 'compressed_app.js')
+         self.jsminEngine          = js_compression.get("engine", self.jsminEngine)
+         self.jsCacheDir           = js_compression.get("cache_dir", self.jsCacheDir)
+         if js_compression.has_key("cache_max_mb"):
+            self.jsCacheMaxBytes = int(js_compression["cache_max_mb"] * 1024 * 1024)
+         self.jsWorkers            = js_compression.get("workers", self.jsWorkers)
+         self.jsChunks             = js_compression.get("split", self.jsChunks)
 
 
-def matchFiles(rootDir, pattern, ignoreDirs = [".svn",".sass-cache",]):
+class SubstTemplate(object):
+   """
+   A subst file parsed into literal text and {% tag %} references, so it can be
+   rendered with a single join however many tags it uses.
+   """
+   TAG_RE = re.compile(r"{%\s*?([\w.-]+)\s*?%}")
+
+   def __init__(self, text):
+      # Alternating literal text and (tag name, original tag text)
+      self.parts = []
+      pos = 0
+      for match in self.TAG_RE.finditer(text):
+         self.parts.append(text[pos:match.start()])
+         self.parts.append((match.group(1), match.group(0)))
+         pos = match.end()
+      self.parts.append(text[pos:])
+
+   def render(self, tagValues):
+      """
+      @param tagValues: Map from tag name to replacement text.  Tags not in the
+                        map are left as they are.
+      """
+      result = []
+      for (i, part) in enumerate(self.parts):
+         if i % 2:
+            part = tagValues.get(part[0], part[1])
+         result.append(part)
+      return "".join(result)
+
+
+def substCssFiles(fileMap):
+   css_files = fileMap.get("css_files", None)
+   if not css_files:
+      return None
+   lines = ["<!-- CSS Files -->\n"]
+   for css_file in css_files:
+      css_file = css_file.replace("\\", "/")
+      lines.append('<link rel="stylesheet" href="%s" type="text/css"/>\n' % css_file)
+   return "".join(lines)
+
+def substJsFiles(fileMap):
+   js_files = fileMap.get("js_files", None)
+   if not js_files:
+      return None
+   lines = ["<!-- JS Files -->\n"]
+   for js_file in js_files:
+      js_file = js_file.replace("\\", "/")
+      lines.append('<script type="text/javascript" src="%s"></script>\n' % js_file)
+   return "".join(lines)
+
+def substDatetime(fileMap):
+   return str(datetime.datetime.now())
+
+def substCacheFiles(fileMap):
+   lines = []
+   for (fg_key, files) in fileMap.iteritems():
+      for file_path in files:
+         file_path = os.path.normpath(file_path)
+         file_path = file_path.replace("\\", "/")
+         lines.append("%s\n" % file_path)
+   return "".join(lines)
+
+# Tags every subst file can use, see Project.registerSubstTag to add more
+DEFAULT_SUBST_TAGS = {
+   "css_files"   : substCssFiles,
+   "js_files"    : substJsFiles,
+   "datetime"    : substDatetime,
+   "cache_files" : substCacheFiles,
+}
+
+
+class Profiler(object):
+   """
+   Records how long the phases of a build take.
+
+   Code marks a phase with "with profiler.span(name):", or with start() and
+   Span.stop() where a with block does not fit.  Spans nest, and each one
+   gets its wall and cpu time plus counters such as the number of files and
+   bytes it processed.  Finished spans are passed to every hook function
+   (see addHook), and kept for summary() and writeTrace() if record is set.
+
+   note: cpu time is that of the whole process, so it includes the other
+         threads and is only a rough guide inside the thread pools.
+
+   @ivar spans: The last MAX_SPANS finished spans, if recording.  Monitor and
+                serve modes keep going, so older ones are let go.
+   @ivar traceFile: Where writeTrace() writes the spans to.
+   """
+   MAX_SPANS = 100000
+
+   def __init__(self):
+      self.record    = False
+      self.traceFile = None
+      self.spans     = collections.deque(maxlen = self.MAX_SPANS)
+      self.hooks     = []
+      self.startTime = time.time()
+      self.local     = threading.local()   # Stack of open spans of each thread
+
+   def active(self):
+      """ Return True if anything looks at the spans, so counters are worth working out. """
+      return self.record or bool(self.hooks)
+
+   def addHook(self, func):
+      """ Call func(span) with every span as it finishes. """
+      self.hooks.append(func)
+
+   def removeHook(self, func):
+      self.hooks.remove(func)
+
+   def span(self, name, **args):
+      """ Return a new Span to use with "with", args are shown in the trace. """
+      return Span(self, name, args)
+
+   def start(self, name, **args):
+      """ Return a new Span, already started. """
+      return Span(self, name, args).__enter__()
+
+   def openSpans(self):
+      if not hasattr(self.local, "stack"):
+         self.local.stack = []
+      return self.local.stack
+
+   def finished(self, span):
+      if self.record:
+         self.spans.append(span)
+      for hook in self.hooks:
+         hook(span)
+
+   def summary(self):
+      """ Return a table of the total time, files and bytes of each kind of span. """
+      totals = {}
+      order  = []
+      for span in sorted(self.spans, key = lambda span: span.startTime):
+         if not totals.has_key(span.name):
+            totals[span.name] = [0, 0.0, 0.0, 0, 0]
+            order.append(span.name)
+         total = totals[span.name]
+         total[0] += 1
+         total[1] += span.wallTime
+         total[2] += span.cpuTime
+         total[3] += span.counters.get("files", 0)
+         total[4] += span.counters.get("bytes", 0)
+
+      lines = ["%-20s %6s %10s %10s %8s %12s" %
+               ("phase", "calls", "wall (s)", "cpu (s)", "files", "bytes")]
+      for name in order:
+         lines.append("%-20s %6d %10.4f %10.4f %8d %12d" % tuple([name] + totals[name]))
+      return "\n".join(lines)
+
+   def numberedTraceFile(self, number):
+      """ Return traceFile with number put before its extension, None if not set. """
+      if not self.traceFile:
+         return None
+      (root, ext) = os.path.splitext(self.traceFile)
+      return "%s.%d%s" % (root, number, ext)
+
+   def writeTrace(self, fname = None, spans = None):
+      """
+      Write spans (default all kept) to fname (default traceFile) in Chrome
+      trace event format.
+      """
+      fname = fname or self.traceFile
+      if not fname:
+         return
+      if spans is None:
+         spans = self.spans
+      events = []
+      for span in spans:
+         args = dict(span.args)
+         args.update(span.counters)
+         args["cpu_ms"] = round(span.cpuTime * 1000, 3)
+         events.append({"name" : span.name,
+                        "cat"  : "p5",
+                        "ph"   : "X",
+                        "ts"   : int((span.startTime - self.startTime) * 1000000),
+                        "dur"  : int(span.wallTime * 1000000),
+                        "pid"  : os.getpid(),
+                        "tid"  : span.threadId,
+                        "args" : args})
+      writeFileIfChanged(fname, json.dumps({"traceEvents"     : events,
+                                            "displayTimeUnit" : "ms"}))
+
+
+class Span(object):
+   """
+   A timed phase (see Profiler).  Leaving a span also ends any spans started
+   inside it that were not stopped, such as when an exception skipped them.
+
+   @ivar counters: Map from counter name ("files", "bytes", ...) to its value.
+   """
+   def __init__(self, profiler, name, args):
+      self.profiler  = profiler
+      self.name      = name
+      self.args      = args
+      self.counters  = {}
+      self.startTime = None
+      self.startCpu  = None
+      self.wallTime  = 0.0
+      self.cpuTime   = 0.0
+      self.threadId  = threading.current_thread().ident
+
+   def __enter__(self):
+      self.profiler.openSpans().append(self)
+      self.startTime = time.time()
+      self.startCpu  = sum(os.times()[:2])
+      return self
+
+   def __exit__(self, excType, excValue, traceback):
+      self.stop()
+
+   def stop(self, **counters):
+      """ End the span, adding counters to its counters. """
+      self.count(**counters)
+      stack = self.profiler.openSpans()
+      if self not in stack:
+         return
+      while stack:
+         span = stack.pop()
+         span.wallTime = time.time() - span.startTime
+         span.cpuTime  = sum(os.times()[:2]) - span.startCpu
+         self.profiler.finished(span)
+         if span is self:
+            break
+
+   def count(self, **counters):
+      for (key, value) in counters.iteritems():
+         self.counters[key] = self.counters.get(key, 0) + value
+
+
+class BuildCancelled(Exception):
+   """ Raised by Project.runBuild when it was told to stop part way. """
+
+
+class RebuildScheduler(object):
+   """
+   Tells a monitoring loop what to rebuild, and when.
+
+   Changes are debounced: once something changes we wait until nothing has
+   changed for debounce seconds (but no more than maxDelay in all), so a burst
+   like a checkout of many files turns into a single build.  Everything that
+   changed since the last build is merged into one change set.  While a build
+   runs, isStale() tells it whether one of its source files changed again, so
+   it can stop early and let the next build start from the latest state.
+
+   On Linux we sleep until inotify reports a change in one of the watched
+   directories, otherwise (or if poll is True) we check every interval seconds.
+
+   @ivar fileDetails: Map from file to its mtime at the last check.
+   @ivar pendingFiles: Files changed since the last build, None for a full build.
+   """
+   def __init__(self, project, buildIds, interval, poll = False, debounce = 0.1,
+                maxDelay = 2.0):
+      self.project  = project
+      self.buildIds = buildIds
+      self.interval = interval
+      self.debounce = debounce
+      self.maxDelay = maxDelay
+
+      self.fileDetails  = {}
+      self.confDetails  = None
+      self.pending      = False
+      self.pendingFiles = set()
+      self.lastStaleCheck = 0
+      self.sawEvents      = False   # isStale read events we haven't looked at yet
+      self.stale          = False   # isStale said so, until the next build
+
+      self.watcher = None
+      if not poll:
+         self.watcher = InotifyWatcher.create()
+
+   def changes(self):
+      """
+      Generator yielding the change set to build next each time something
+      changed (see Project.runBuild changedFiles).  It waits for the next
+      change when resumed, unless a cancelled build was requeued.
+
+      A stat cycle stays open throughout and every check starts a new
+      generation of it, so the build after a check reuses the stats it took.
+      """
+      with self.project.statCache.cycle():
+         while True:
+            if self.detectChanges():
+               # Wait out the rest of the burst
+               deadline = time.time() + self.maxDelay
+               while time.time() < deadline:
+                  if not self.waitForChange(min(self.debounce, deadline - time.time())):
+                     break
+                  if not self.detectChanges():
+                     break
+            if self.pending:
+               changed_files = self.pendingFiles
+               self.pending      = False
+               self.pendingFiles = set()
+               self.watchDirs()     # So isStale sees changes made during the build
+               self.stale = False
+               yield changed_files
+
+            if not (self.pending or self.sawEvents):
+               self.watchDirs()
+               self.waitForChange(None)
+            self.sawEvents = False
+
+   def requeue(self, changedFiles):
+      """ Add the changes of a cancelled build back in for the next one. """
+      self.addPending(changedFiles)
+
+   def addPending(self, changedFiles):
+      if changedFiles is None:
+         self.pendingFiles = None
+      elif self.pendingFiles is not None:
+         self.pendingFiles.update(changedFiles)
+      self.pending = True
+
+   def detectChanges(self):
+      """
+      Look for changes since the last check, adding them to the pending changes.
+      Returns True if there were any.
+      """
+      project = self.project
+      stats   = project.statCache
+      stats.invalidate()
+
+      # -- CHECK FOR CONF FILE CHANGES --- #
+      # if there are changes, reload the file
+      conf_reloaded = False
+      new_conf_details = stats.stat(project.confFile).st_mtime
+      if new_conf_details != self.confDetails:
+         self.confDetails = new_conf_details
+         print "Changed conf detected, reloading..."
+         project.loadConfig(project.confFile)
+         conf_reloaded = True
+
+      # -- UPDATE ALL THE FILE GROUPS -- #
+      # this catches any newly matched file names
+      span = project.profiler.start("detect_changes")
+      project.updateFileGroups(self.buildIds)
+
+      # Get full file list, we monitor all of these for changes.  Directories
+      # are not, the scan above relists the ones whose mtime changed and new
+      # or removed files show up in the lists.  The compressed files the build
+      # writes next to the sources are left out, they are not changes.
+      last_file_details = self.fileDetails
+      new_file_details = {}
+      outputs = project.getCompressedOutputs(self.buildIds)
+
+      for buildKey in self.buildIds:
+         file_list = project.getFullFileList(buildKey)
+         for fname in file_list:
+            if not new_file_details.has_key(fname) and os.path.abspath(fname) not in outputs:
+               new_file_details[fname] = stats.stat(fname).st_mtime
+
+      span.stop(files = len(new_file_details))
+
+      # -- CHECK FOR CHANGES --- #
+      if last_file_details == new_file_details and not conf_reloaded:
+         return False
+
+      if len(last_file_details) != len(new_file_details):
+         sym_diff = set(last_file_details.keys()).symmetric_difference(set(new_file_details.keys()))
+         print "Found files changed [%s]..." % list(sym_diff)
+
+      # Find the changes
+      for (fname, mtime) in new_file_details.iteritems():
+         old_time = last_file_details.get(fname, None)
+         if (old_time != None) and (mtime != old_time):
+            print "file changed: ", fname
+
+      # Only a full build after startup or a conf change, otherwise just
+      # redo what the changed files need
+      changed_files = None
+      if last_file_details and not conf_reloaded:
+         changed_files = set([fname for (fname, mtime) in new_file_details.iteritems()
+                              if last_file_details.get(fname, None) != mtime])
+         changed_files.update(set(last_file_details) - set(new_file_details))
+
+      self.fileDetails = new_file_details
+      self.addPending(changed_files)
+      return True
+
+   def watchDirs(self):
+      if self.watcher is not None:
+         try:
+            self.watcher.watchDirs(self.project.getWatchDirs(self.buildIds))
+         except OSError, e:
+            print "Can't watch for changes (%s), falling back to polling" % e
+            self.watcher.close()
+            self.watcher = None
+
+   def waitForChange(self, timeout):
+      """
+      Wait for something to change, up to timeout seconds (None for the
+      polling interval or, with inotify, for ever).  Returns False if we know
+      nothing changed.
+      """
+      if self.watcher is not None:
+         return bool(self.watcher.wait(timeout))
+      if timeout is None:
+         timeout = self.interval
+      time.sleep(timeout)
+      return True
+
+   def isStale(self):
+      """
+      Return True if one of the files the current build uses changed since
+      it started.  New files are only looked for once the build is over.
+      """
+      if self.stale:
+         return True    # Every build running at once has to hear about it
+      self.stale = self.checkStale()
+      return self.stale
+
+   def checkStale(self):
+      if self.watcher is not None:
+         changed = self.watcher.readEvents()
+         if not changed:
+            return False
+         self.sawEvents = True
+         candidates = [f for f in self.fileDetails if os.path.abspath(f) in changed]
+      else:
+         # Stat'ing everything is not free, so only do it every interval
+         now = time.time()
+         if now - self.lastStaleCheck < self.interval:
+            return False
+         self.lastStaleCheck = now
+         candidates = [f for f in self.fileDetails if os.path.isfile(f)]
+
+      # Not through the stat cache, this is looking for what changed since
+      for fname in candidates:
+         try:
+            if os.stat(fname).st_mtime != self.fileDetails[fname]:
+               return True
+         except OSError:
+            return True
+      return False
+
+
+class BuildManifest(object):
+   """
+   Record kept in a target directory of what the last build put there.
+
+   For each source we store the size and mtime it had when we last processed
+   it (plus its content hash when useHash is set) and the hash of the output
+   we produced where we know it.  A build then only needs to stat the sources
+   to tell what changed, never the targets.  With useHash a source whose mtime
+   changed but whose content did not (a fresh checkout) counts as unchanged.
+
+   Entries are kept in sections, so the same source can be tracked separately
+   as a copied file and as an input to the compressed js.
+
+   note: changes made by hand inside the target directory are not noticed,
+         clobber the build to start over.
+   """
+   FILENAME = ".p5_manifest.json"
+   VERSION  = 1
+
+   def __init__(self, targetDir, useHash = False, statCache = None):
+      self.fname    = pj(targetDir, self.FILENAME)
+      self.useHash  = useHash
+      self.stats    = statCache or StatCache()
+      self.sections = {}   # Map from section to map from source to entry dict
+      self.state    = {}   # Other build state to compare against next time
+      self.dirty    = False
+      self._seen    = {}   # Map from source to [stat, hash] taken this build
+      self._loadedState = {}
+      self.load()
+
+   def load(self):
+      try:
+         data = json.loads(open(self.fname, 'r').read())
+      except (IOError, ValueError):
+         return
+      if data.get("version", None) == self.VERSION:
+         self.sections = data.get("sections", {})
+         self.state    = data.get("state", {})
+         self._loadedState = copy.deepcopy(self.state)
+
+   def save(self):
+      """ Write the manifest out (atomically) if anything changed. """
+      if not self.dirty and self.state == self._loadedState:
+         return
+      target_dir = os.path.dirname(self.fname)
+      if not os.path.exists(target_dir):
+         os.makedirs(target_dir)
+      (fd, tmp_fname) = makeTempFile(self.fname)
+      out_file = os.fdopen(fd, 'w')
+      try:
+         json.dump({"version"  : self.VERSION,
+                    "sections" : self.sections,
+                    "state"    : self.state}, out_file)
+      finally:
+         out_file.close()
+      replaceFile(tmp_fname, self.fname)
+      self.dirty = False
+      self._loadedState = copy.deepcopy(self.state)
+
+   def refresh(self, srcFname):
+      """ Forget what we saw of srcFname this build, call after rewriting it. """
+      self._seen.pop(srcFname, None)
+      self.stats.forget(srcFname)
+
+   def _stat(self, srcFname):
+      if not self._seen.has_key(srcFname):
+         self._seen[srcFname] = [self.stats.stat(srcFname), None]
+      return self._seen[srcFname]
+
+   def _hash(self, srcFname):
+      seen = self._stat(srcFname)
+      if seen[1] is None:
+         seen[1] = fileHash(srcFname)
+      return seen[1]
+
+   def hasChanged(self, srcFname, section):
+      """ Return True if srcFname changed since it was last recorded in section. """
+      entry = self.sections.get(section, {}).get(srcFname, None)
+      if entry is None:
+         return True
+      stats = self._stat(srcFname)[0]
+      if entry["size"] != stats.st_size:
+         return True
+      if entry["mtime"] == stats.st_mtime:
+         return False
+      if self.useHash and entry.get("hash", None) == self._hash(srcFname):
+         entry["mtime"] = stats.st_mtime    # Same content, remember the new time
+         self.dirty = True
+         return False
+      return True
+
+   def knownOutputHash(self, srcFname, section):
+      """
+      Return the output hash recorded for srcFname in section if the source has
+      not changed since, otherwise None.
+      """
+      if self.hasChanged(srcFname, section):
+         return None
+      return self.sections[section][srcFname].get("output_hash", None)
+
+   def knownHash(self, srcFname):
+      """
+      Return the content hash of srcFname recorded in any section with its
+      current size and mtime, so it need not be read again, otherwise None.
+      """
+      seen = self._stat(srcFname)
+      if seen[1] is None:
+         stats = seen[0]
+         for entries in self.sections.itervalues():
+            entry = entries.get(srcFname, None)
+            if (entry is not None and entry.has_key("hash") and
+                entry["size"] == stats.st_size and entry["mtime"] == stats.st_mtime):
+               seen[1] = entry["hash"]
+               break
+      return seen[1]
+
+   def identity(self, srcFnames):
+      """
+      Return (time, id) identifying the state of the inputs srcFnames.  The id
+      is a hash of their names and sizes and mtimes (content hashes if we are
+      hashing), the time is when the build first saw that id.  Both stay the
+      same from build to build until an input changes.
+      """
+      hasher = hashlib.sha1()
+      for fname in srcFnames:
+         if self.useHash:
+            key = self.knownHash(fname) or self._hash(fname)
+         else:
+            stats = self._stat(fname)[0]
+            key = "%s:%r" % (stats.st_size, stats.st_mtime)
+         hasher.update("%s\0%s\n" % (fname, key))
+      build_id = hasher.hexdigest()
+
+      last = self.state.get("identity", None)
+      if last is None or last["id"] != build_id:
+         last = {"id" : build_id, "time" : time.time()}
+         self.state["identity"] = last
+      return (last["time"], last["id"])
+
+   def record(self, srcFname, section, outputHash = None):
+      """
+      Record that we processed srcFname in section.  For copies the output hash
+      defaults to the source content hash if we are hashing.
+      """
+      stats = self._stat(srcFname)[0]
+      entry = {"size" : stats.st_size, "mtime" : stats.st_mtime}
+      if self.useHash:
+         entry["hash"] = self._hash(srcFname)
+         if outputHash is None:
+            outputHash = entry["hash"]
+      entry["output_hash"] = outputHash
+      entries = self.sections.setdefault(section, {})
+      if entries.get(srcFname, None) != entry:   # A build with no changes writes nothing
+         entries[srcFname] = entry
+         self.dirty = True
+
+
+class FileCopier(object):
+   """
+   Copies files into a build on a pool of threads.
+
+   All target directories are created up front.  Each file is then copied in
+   the kernel (copy_file_range, or sendfile) where we can, which also lets the
+   threads run in parallel, with a plain copy as the fallback.  Timestamps and
+   permissions are kept like shutil.copy2.
+
+   Modes:
+      "copy"     - copy the data (default)
+      "hardlink" - hard link targets to the sources, for builds on the same
+                   file system.  Falls back to a copy across file systems.
+      "reflink"  - share the data blocks copy-on-write (btrfs, xfs), falls back
+                   to a copy where not supported.
+   """
+   MODES   = ("copy", "hardlink", "reflink")
+   FICLONE = 0x40049409    # ioctl request for reflinks (linux/fs.h)
+
+   def __init__(self, mode = "copy", workers = 4):
+      assert mode in self.MODES, "Invalid copy mode: %s" % mode
+      self.mode    = mode
+      self.workers = workers
+
+   def copyFiles(self, copyJobs, allowLinks = True):
+      """
+      @param copyJobs: list of (source, target) file names.
+      @param allowLinks: If False, always copy the data whatever the mode.
+      """
+      if not copyJobs:
+         return
+
+      for dir_name in sorted(set([os.path.dirname(t) for (s, t) in copyJobs])):
+         if dir_name:
+            try:
+               os.makedirs(dir_name)
+            except OSError, e:
+               if e.errno != errno.EEXIST:
+                  raise
+
+      mode = self.mode
+      if not allowLinks:
+         mode = "copy"
+      jobs = [(mode, src, target) for (src, target) in copyJobs]
+      runThreaded(self.copyFile, jobs, self.workers)
+
+   @staticmethod
+   def copyFile(args):
+      (mode, src, target) = args
+
+      # Never write through an existing target, it may be a hard link to the
+      # source from an earlier build.
+      try:
+         os.remove(target)
+      except OSError, e:
+         if e.errno != errno.ENOENT:
+            raise
+
+      if mode == "hardlink":
+         try:
+            os.link(src, target)
+            return
+         except (OSError, AttributeError):
+            pass
+
+      in_file = open(src, 'rb')
+      try:
+         out_file = open(target, 'wb')
+         try:
+            copied = False
+            if mode == "reflink" and fcntl is not None:
+               try:
+                  fcntl.ioctl(out_file.fileno(), FileCopier.FICLONE, in_file.fileno())
+                  copied = True
+               except IOError:
+                  pass
+            if not copied:
+               copyFileData(in_file, out_file)
+         finally:
+            out_file.close()
+      finally:
+         in_file.close()
+      shutil.copystat(src, target)
+
+
+class SharedWork(object):
+   """
+   Work shared by the builds of one Project.runBuild, so what several builds
+   need is only done once.  The first build to ask for a key does the work,
+   the others wait for it and get the same result (or exception).
+   """
+   def __init__(self):
+      self.lock    = threading.Lock()
+      self.entries = {}   # Map from key to [done event, result, exc_info]
+
+   def run(self, key, func, *args):
+      """
+      Return (result of func(*args), True if we called it) for key, unless it
+      was already done for key.
+      """
+      self.lock.acquire()
+      try:
+         entry = self.entries.get(key, None)
+         owner = entry is None
+         if owner:
+            entry = [threading.Event(), None, None]
+            self.entries[key] = entry
+      finally:
+         self.lock.release()
+
+      if owner:
+         try:
+            entry[1] = func(*args)
+         except:
+            entry[2] = sys.exc_info()
+            raise
+         finally:
+            entry[0].set()
+      else:
+         entry[0].wait()
+         if entry[2] is not None:
+            raise entry[2][0], entry[2][1], entry[2][2]
+      return (entry[1], owner)
+
+
+class BuildOutput(object):
+   """
+   File like object passing what the threads write to it on to outFile a whole
+   line at a time, each line starting with the prefix its thread set.
+   """
+   def __init__(self, outFile):
+      self.outFile = outFile
+      self.lock    = threading.Lock()
+      self.local   = threading.local()
+
+   def setPrefix(self, prefix):
+      """ Start the lines the calling thread writes with prefix. """
+      self.flush()
+      self.local.prefix = prefix
+
+   def write(self, data):
+      buffer = getattr(self.local, "buffer", "") + data
+      if "\n" in buffer:
+         (lines, buffer) = buffer.rsplit("\n", 1)
+         prefix = getattr(self.local, "prefix", "")
+         self.lock.acquire()
+         try:
+            for line in lines.split("\n"):
+               self.outFile.write(prefix + line + "\n")
+         finally:
+            self.lock.release()
+      self.local.buffer = buffer
+
+   def flush(self):
+      if getattr(self.local, "buffer", ""):
+         self.write("\n")
+      self.lock.acquire()
+      try:
+         self.outFile.flush()
+      finally:
+         self.lock.release()
+
+
+def runThreaded(func, items, workers):
+   """
+   Call func on each of items with up to workers threads, returning the results
+   in order.  Once all are done the first exception raised (if any) is raised
+   again.  (multiprocessing.pool.ThreadPool takes 0.1s to shut down on python 2,
+   too much for work that often takes a few ms)
+   """
+   items = list(items)
+   if workers <= 1 or len(items) <= 1:
+      return map(func, items)
+
+   results = [None] * len(items)
+   errors  = []
+   indexes = iter(range(len(items)))
+   lock    = threading.Lock()
+
+   def work():
+      while True:
+         lock.acquire()
+         try:
+            i = next(indexes, None)
+         finally:
+            lock.release()
+         if i is None:
+            return
+         try:
+            results[i] = func(items[i])
+         except:
+            errors.append(sys.exc_info())
+
+   threads = [threading.Thread(target = work) for i in range(min(workers, len(items)))]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+   if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+   return results
+
+
+class Precompressor(object):
+   """
+   Writes precompressed copies of text outputs next to them (app.js.gz, and
+   app.js.br when the brotli module is installed) so web servers can send them
+   as is instead of compressing on every request.
+
+   Files smaller than minSize are not worth it, any old sidecars of theirs are
+   removed.  Output is deterministic (no timestamps in the gzip header) and only
+   written when it changes.
+   """
+   EXTENSIONS = [".js", ".css", ".html", ".htm", ".json", ".svg", ".txt", ".xml",
+                 ".map", ".manifest", ".appcache"]
+
+   def __init__(self, min_size = 1024, extensions = None, codecs = None, workers = 0):
+      self.minSize    = min_size
+      self.extensions = extensions or self.EXTENSIONS
+      self.codecs     = [c for c in (codecs or self.availableCodecs())
+                         if c in self.availableCodecs()]
+      self.workers    = workers or multiprocessing.cpu_count()
+      self.shared     = None    # Optional SharedWork, to compress the same data once
+
+   def settings(self):
+      """ Return the settings that affect the output, to tell if they changed. """
+      return {"min_size" : self.minSize, "extensions" : self.extensions, "codecs" : self.codecs}
+
+   @staticmethod
+   def availableCodecs():
+      codecs = ["gzip"]
+      if brotli is not None:
+         codecs.append("br")
+      return codecs
+
+   @staticmethod
+   def gzipData(data):
+      buf = StringIO.StringIO()
+      gz_file = gzip.GzipFile(filename = "", mode = "wb", compresslevel = 9,
+                              fileobj = buf, mtime = 0)
+      gz_file.write(data)
+      gz_file.close()
+      return buf.getvalue()
+
+   CODECS = {
+      "gzip" : (".gz", lambda data: Precompressor.gzipData(data)),
+      "br"   : (".br", lambda data: brotli.compress(data)),
+   }
+
+   def run(self, fnames):
+      fnames = [f for f in fnames if os.path.splitext(f)[1].lower() in self.extensions]
+      # zlib and brotli release the GIL, so threads are enough
+      runThreaded(self.compressFile, fnames, self.workers)
+
+   def compressFile(self, fname):
+      try:
+         data = open(fname, 'rb').read()
+      except IOError:
+         return
+      for codec in self.codecs:
+         (ext, compress) = self.CODECS[codec]
+         if len(data) >= self.minSize:
+            if self.shared is not None:
+               (compressed, computed) = self.shared.run(
+                  (codec, hashlib.sha1(data).hexdigest()), compress, data)
+            else:
+               compressed = compress(data)
+            if writeFileIfChanged(fname + ext, compressed):
+               print "Precompressed: %s%s" % (fname, ext)
+         else:
+            try:
+               os.remove(fname + ext)
+            except OSError:
+               pass
+
+
+class MinifyCache(object):
+   """
+   Content addressable on-disk cache of minified output, safe to share
+   between builds, processes and machines (an NFS mount for CI agents).
+
+   Entries are keyed by a hash of the source content, the compression level
+   and the minifier version, and stored one per file under cacheDir.  Both the
+   output of each source file and the whole combined output (keyed on all of
+   its inputs) are kept, so an identical build anywhere is a single fetch.
+
+   Every entry starts with a header holding the sha1 and size of its data,
+   damaged or truncated entries fail the check and are removed.  Writers fill
+   a temp file next to the entry and rename it into place, so readers only
+   ever see complete entries and concurrent writers of the same entry (which
+   have the same content) don't clash.  The mtime of an entry is bumped
+   whenever it is used, so prune() can evict the least recently used entries
+   once the cache grows past maxBytes.  A read only cache works, it just
+   never gets new entries.
+   """
+   MAGIC  = "p5cache"
+   FORMAT = 1
+   HEADER_SIZE = len("%s %d %s %020d\n" % (MAGIC, FORMAT, "0" * 40, 0))
+
+   # A whole cache is only walked for eviction this often (the mtime of the
+   # STAMP file), and temp files this old are left overs of a crashed writer.
+   PRUNE_INTERVAL = 300
+   STALE_TEMP_SECONDS = 3600
+   STAMP = ".pruned"
+
+   def __init__(self, cacheDir, maxBytes):
+      self.cacheDir = os.path.expanduser(cacheDir)
+      self.maxBytes = maxBytes
+
+   @classmethod
+   def makeKey(cls, data, compressionLevel, version):
+      # The entry format is part of the key, entries of older formats are
+      # plain misses and age out of the cache
+      hasher = hashlib.sha1()
+      hasher.update("%s:%s:%s:" % (cls.FORMAT, compressionLevel, version))
+      hasher.update(data)
+      return hasher.hexdigest()
+
+   @classmethod
+   def makeHeader(cls, digest, size):
+      return "%s %d %s %020d\n" % (cls.MAGIC, cls.FORMAT, digest, size)
+
+   def entryPath(self, key):
+      return pj(self.cacheDir, key[:2], key)
+
+   def has(self, key):
+      return os.path.exists(self.entryPath(key))
+
+   def openEntry(self, key):
+      """
+      Return a CacheEntryReader of the data for key, or None if we don't have
+      it.  Entries that are not the size their header says are removed here,
+      the sha1 is checked as the data is read so it is only fetched once.
+      """
+      path = self.entryPath(key)
+      try:
+         in_file = open(path, 'rb')
+      except IOError:
+         return None
+      try:
+         header = in_file.read(self.HEADER_SIZE)
+         size   = os.fstat(in_file.fileno()).st_size - self.HEADER_SIZE
+         digest = header.split(" ")[2]
+         if header == self.makeHeader(digest, size):
+            self.touch(path)
+            return CacheEntryReader(in_file, digest, path)
+      except (IOError, OSError, IndexError):
+         pass
+      in_file.close()
+      self.damaged(path)
+      return None
+
+   def get(self, key):
+      """ Return the cached data for key or None if we don't have it. """
+      path = self.entryPath(key)
+      try:
+         data = open(path, 'rb').read()
+      except IOError:
+         return None
+      header = data[:self.HEADER_SIZE]
+      data   = data[self.HEADER_SIZE:]
+      if header != self.makeHeader(hashlib.sha1(data).hexdigest(), len(data)):
+         self.damaged(path)
+         return None
+      self.touch(path)
+      return data
+
+   @classmethod
+   def damaged(cls, path):
+      print "Removing damaged cache entry: %s" % path
+      cls.discard(path)
+
+   def put(self, key, data):
+      """ Store data for key. """
+      entry = self.startEntry(key)
+      if entry is not None:
+         try:
+            entry.write(data)
+            entry.commit()
+         finally:
+            entry.abort()
+
+   def startEntry(self, key):
+      """
+      Return a CacheEntryWriter to store the data for key a piece at a time, or
+      None if the cache can't be written to.
+      """
+      path = self.entryPath(key)
+      try:
+         entry_dir = os.path.dirname(path)
+         if not os.path.exists(entry_dir):
+            try:
+               os.makedirs(entry_dir)
+            except OSError, e:
+               if e.errno != errno.EEXIST:    # Made by another writer
+                  raise
+         return CacheEntryWriter(self, path)
+      except (IOError, OSError):
+         return None
+
+   @staticmethod
+   def touch(path):
+      try:
+         os.utime(path, None)
+      except OSError:
+         pass      # Read only cache
+
+   @staticmethod
+   def discard(path):
+      try:
+         os.remove(path)
+      except OSError:
+         pass      # Gone already, or read only
+
+   def prune(self, force = False):
+      """
+      Evict least recently used entries until we are within maxBytes.  Unless
+      forced this does nothing if the cache was pruned in the last
+      PRUNE_INTERVAL seconds, by us or anyone else sharing it.
+      """
+      stamp = pj(self.cacheDir, self.STAMP)
+      now = time.time()
+      if not force:
+         try:
+            if now - os.stat(stamp).st_mtime < self.PRUNE_INTERVAL:
+               return
+         except OSError:
+            pass
+      try:
+         open(stamp, 'w').close()
+      except IOError:
+         return    # Read only, not ours to prune
+
+      entries    = []
+      total_size = 0
+      for root, dirnames, filenames in os.walk(self.cacheDir):
+         for filename in filenames:
+            path = pj(root, filename)
+            try:
+               stats = os.stat(path)
+            except OSError:
+               continue    # Renamed or evicted under us
+            if filename.startswith(".tmp"):
+               if now - stats.st_mtime > self.STALE_TEMP_SECONDS:
+                  self.discard(path)
+            elif filename != self.STAMP:
+               entries.append((stats.st_mtime, stats.st_size, path))
+               total_size += stats.st_size
+
+      entries.sort()
+      for (mtime, size, path) in entries:
+         if total_size <= self.maxBytes:
+            break
+         self.discard(path)
+         total_size -= size
+
+
+class CacheEntryDamaged(IOError):
+   pass
+
+
+class CacheEntryReader(object):
+   """
+   Reads the data of a MinifyCache entry, checking its sha1 once all of it
+   has been read.  If it does not match the entry is removed and read()
+   raises CacheEntryDamaged, the data already returned can't be trusted.
+   """
+   def __init__(self, inFile, digest, path):
+      self.inFile = inFile
+      self.digest = digest
+      self.path   = path
+      self.hasher = hashlib.sha1()
+
+   def read(self, size = -1):
+      data = self.inFile.read(size)
+      self.hasher.update(data)
+      if (not data or size < 0) and self.hasher.hexdigest() != self.digest:
+         MinifyCache.damaged(self.path)
+         raise CacheEntryDamaged("Damaged cache entry %s" % self.path)
+      return data
+
+   def close(self):
+      self.inFile.close()
+
+
+class CacheEntryWriter(object):
+   """
+   Writes a MinifyCache entry into a temp file, which commit() moves into place
+   once complete.  abort() drops it if it was not committed.  Failing to write
+   (a full disk) quietly drops the entry, the cache is only an optimization.
+   """
+   def __init__(self, cache, path):
+      self.cache  = cache
+      self.path   = path
+      self.hasher = hashlib.sha1()
+      self.size   = 0
+      (fd, self.tmpFname) = makeTempFile(path)
+      self.outFile = os.fdopen(fd, 'wb')
+      self.outFile.write(cache.makeHeader("0" * 40, 0))    # Filled in by commit
+
+   def write(self, data):
+      if self.tmpFname is None:
+         return
+      self.hasher.update(data)
+      self.size += len(data)
+      try:
+         self.outFile.write(data)
+      except IOError:
+         self.abort()
+
+   def commit(self):
+      if self.tmpFname is None:
+         return
+      try:
+         self.outFile.seek(0)
+         self.outFile.write(self.cache.makeHeader(self.hasher.hexdigest(), self.size))
+         self.outFile.close()
+         os.rename(self.tmpFname, self.path)
+      except (IOError, OSError):
+         # Out of space, or another writer got there first on a platform that
+         # can't rename over a file, the content is the same either way
+         self.abort()
+         return
+      self.tmpFname = None
+
+   def abort(self):
+      if self.tmpFname is not None:
+         try:
+            self.outFile.close()
+         except IOError:
+            pass
+         MinifyCache.discard(self.tmpFname)
+         self.tmpFname = None
+
+
+class DevServer(object):
+   """
+   Serves a build over http from memory instead of writing it to its target
+   directory, for development.
+
+   Outputs are made the first time they are asked for and kept until one of
+   their inputs changes.  Html subst files get a small script that reloads the
+   page when a rebuild completes (server-sent events from RELOAD_PATH).
+
+   @ivar routes: Map from url path to (kind, output name, input files), kind is
+                 "js", "css" (compressed), "subst" or "file".
+   @ivar outputs: Map from url path to (data, input files) of what was served.
+   @ivar rendering: Map from url path to an Event set once the output being made
+                    for it is done.  Outputs are made outside the lock, so a
+                    slow compress only holds up requests for the same path.
+   @ivar generation: Count of rebuilds, pages reload when it goes up.
+   """
+   RELOAD_PATH   = "/__p5_reload"
+   RELOAD_SCRIPT = ('<script type="text/javascript">new EventSource("%s").onmessage = '
+                    'function() { location.reload(); };</script>\n' % RELOAD_PATH)
+
+   def __init__(self, project, buildKey, host = "127.0.0.1", port = 8000):
+      self.project  = project
+      self.buildKey = buildKey
+      self.address  = (host, port)
+
+      self.lock       = threading.Lock()
+      self.reloaded   = threading.Condition(self.lock)
+      self.generation = 0
+      self.routes     = {}
+      self.tagValues  = {}
+      self.outputs    = {}
+      self.rendering  = {}
+      self.lastGroupedFiles = None
+
+   def run(self, interval, poll = False):
+      """ Serve until interrupted, updating on every change. (see Project.watchChanges) """
+      httpd = None
+      try:
+         for changed_files in self.project.watchChanges([self.buildKey], interval, poll):
+            self.update(changed_files)
+            if httpd is None:
+               httpd = DevHTTPServer(self.address, DevRequestHandler)
+               httpd.devServer = self
+               thread = threading.Thread(target = httpd.serve_forever)
+               thread.daemon = True
+               thread.start()
+               print "Serving %s on http://%s:%d/" % ((self.buildKey,) + self.address)
+            else:
+               print "---- RELOADED ---"
+      finally:
+         if httpd is not None:
+            httpd.shutdown()
+
+   @staticmethod
+   def urlPath(fname):
+      return "/" + os.path.normpath(fname).replace("\\", "/")
+
+   def update(self, changedFiles = None):
+      """
+      Work out the routes for the current file lists and drop the outputs made
+      from changedFiles (all of them if None or the lists changed).
+      """
+      project       = self.project
+      build_config  = project.getBuild(self.buildKey)
+      grouped_files = project.getMergedFileGroup(self.buildKey)
+
+      # Compressed files take the place of their inputs like in a build
+      routes     = {}
+      output_map = dict(grouped_files)
+      if build_config.compressJsLevel > 0:
+         chunks = project.getJsChunks(self.buildKey, grouped_files)
+         for (fname, js_files) in chunks:
+            routes[self.urlPath(fname)] = ("js", fname, js_files)
+         output_map["js_files"] = [c[0] for c in chunks]
+      if build_config.compressCssLevel > 0:
+         css_fname = build_config.compressedCssFilename
+         routes[self.urlPath(css_fname)] = ("css", css_fname, grouped_files.get("css_files", []))
+         output_map["css_files"] = [css_fname]
+      for (fg_key, files) in output_map.iteritems():
+         kind = "file"
+         if fg_key == "subst_files":
+            kind = "subst"
+         for fname in files:
+            routes.setdefault(self.urlPath(fname), (kind, fname, [fname]))
+
+      tag_values = project.renderSubstTags(output_map, project.substTags)
+
+      self.lock.acquire()
+      try:
+         self.generation += 1
+         tag_values["build_id"] = str(self.generation)
+         if changedFiles is None or grouped_files != self.lastGroupedFiles:
+            self.outputs = {}
+         else:
+            for (path, (data, inputs)) in self.outputs.items():
+               # Subst files show the tag values, so they go if those changed
+               if (changedFiles.intersection(inputs) or
+                   (self.routes[path][0] == "subst" and tag_values != self.tagValues)):
+                  del self.outputs[path]
+         self.lastGroupedFiles = grouped_files
+         self.routes     = routes
+         self.tagValues  = tag_values
+         self.reloaded.notifyAll()
+      finally:
+         self.lock.release()
+
+   def getOutput(self, path):
+      """ Return the data to serve for url path, None if there is nothing there. """
+      while True:
+         self.lock.acquire()
+         try:
+            output = self.outputs.get(path, None)
+            if output is not None:
+               return output[0]
+            route = self.routes.get(path, None)
+            if route is None:
+               return None
+            in_flight = self.rendering.get(path, None)
+            if in_flight is None:
+               in_flight = threading.Event()
+               self.rendering[path] = in_flight
+               (generation, tag_values) = (self.generation, self.tagValues)
+               break
+         finally:
+            self.lock.release()
+         in_flight.wait()     # Made by another request, take it from outputs
+
+      output = None
+      try:
+         with self.project.profiler.span("render", output = route[1]) as span:
+            output = (self.render(route, tag_values), route[2])
+            span.count(files = len(route[2]), bytes = len(output[0]))
+      finally:
+         self.lock.acquire()
+         try:
+            del self.rendering[path]
+            # Something changed while we made it, it may be out of date already
+            if output is not None and self.generation == generation:
+               self.outputs[path] = output
+            in_flight.set()
+         finally:
+            self.lock.release()
+      return output[0]
+
+   def render(self, route, tagValues):
+      (kind, fname, inputs) = route
+      build_config = self.project.getBuild(self.buildKey)
+      if kind == "js":
+         cache = self.project.getMinifyCache(build_config.jsCacheDir,
+                                             build_config.jsCacheMaxBytes)
+         # This runs in a request thread, forking a pool of workers from one
+         # can hang, so the files are minified here one after the other
+         print "Compressing: %s" % fname
+         return "".join(Project.iterCompressedJs(build_config.compressJsLevel, inputs,
+                                                 build_config.jsminEngine, cache, 1))
+      elif kind == "css":
+         cache = self.project.getMinifyCache(build_config.cssCacheDir,
+                                             build_config.cssCacheMaxBytes)
+         print "Compressing: %s" % fname
+         return "".join(Project.iterCompressedCss(build_config.compressCssLevel, inputs,
+                                                  fname, cache))
+      elif kind == "subst":
+         data = self.project.getSubstTemplate(fname).render(tagValues)
+         if os.path.splitext(fname)[1].lower() in (".html", ".htm"):
+            pos = data.lower().rfind("</body>")
+            if pos == -1:
+               pos = len(data)
+            data = data[:pos] + self.RELOAD_SCRIPT + data[pos:]
+         return data
+      else:
+         return open(fname, 'rb').read()
+
+   def waitForReload(self, generation, timeout):
+      """ Wait until the generation is past the given one, return the current one. """
+      self.reloaded.acquire()
+      try:
+         if self.generation == generation:
+            self.reloaded.wait(timeout)
+         return self.generation
+      finally:
+         self.reloaded.release()
+
+
+class DevHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+
+
+class DevRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   """ Request handler of a DevServer, which is at self.server.devServer. """
+   CONTENT_TYPES = {".manifest" : "text/cache-manifest"}
+
+   def do_GET(self):
+      dev_server = self.server.devServer
+      path = urllib.unquote(self.path.split("?", 1)[0].split("#", 1)[0])
+      if path == DevServer.RELOAD_PATH:
+         self.sendReloadEvents(dev_server)
+         return
+      if path.endswith("/"):
+         path += "index.html"
+
+      try:
+         data = dev_server.getOutput(path)
+      except (IOError, OSError), e:
+         self.send_error(500, str(e))
+         return
+      if data is None:
+         self.send_error(404)
+         return
+
+      ext = os.path.splitext(path)[1].lower()
+      content_type = self.CONTENT_TYPES.get(ext, None) or mimetypes.guess_type(path)[0]
+      self.send_response(200)
+      self.send_header("Content-Type", content_type or "application/octet-stream")
+      self.send_header("Content-Length", str(len(data)))
+      self.send_header("Cache-Control", "no-cache")
+      self.end_headers()
+      if self.command != "HEAD":
+         self.wfile.write(data)
+
+   do_HEAD = do_GET
+
+   def sendReloadEvents(self, devServer, keepAlive = 15):
+      """ Stream an event each time the server reloads, until the client goes away. """
+      self.send_response(200)
+      self.send_header("Content-Type", "text/event-stream")
+      self.send_header("Cache-Control", "no-cache")
+      self.end_headers()
+      generation = devServer.generation
+      try:
+         while True:
+            new_generation = devServer.waitForReload(generation, keepAlive)
+            if new_generation != generation:
+               generation = new_generation
+               self.wfile.write("data: reload\n\n")
+            else:
+               self.wfile.write(": keep alive\n\n")
+            self.wfile.flush()
+      except socket.error:
+         pass
+
+
+class BuildDaemon(object):
+   """
+   Keeps a configured Project (and the file lists and directory caches it
+   holds) loaded, and runs the build, clobber and status requests DaemonClient
+   sends over a Unix domain socket, one at a time.  The configuration is
+   reloaded when the file changes.
+
+   Requests and replies are lines of JSON.  The reply is the output of the
+   request, one {"output": line} at a time, then {"status": exit status}.
+   """
+   def __init__(self, project, socketPath):
+      self.project    = project
+      self.socketPath = socketPath
+      self.confMtime  = os.stat(project.confFile).st_mtime
+      self.startTime  = time.time()
+      self.requests   = 0
+      self.lastBuilds = {}     # Map from build key to (time, seconds taken)
+      self.stopped    = False
+
+   def serve(self):
+      if not hasattr(socket, "AF_UNIX"):
+         raise SystemExit("The daemon needs Unix domain sockets")
+      if DaemonClient(self.socketPath).connect() is not None:
+         raise SystemExit("A daemon is already running on %s" % self.socketPath)
+      if os.path.exists(self.socketPath):
+         os.remove(self.socketPath)   # Left behind by a daemon that died
+
+      old_umask = os.umask(0077)
+      try:
+         server = SocketServer.UnixStreamServer(self.socketPath, DaemonRequestHandler)
+      finally:
+         os.umask(old_umask)
+      server.buildDaemon = self
+      print "Daemon for %s listening on %s" % (self.project.confFile, self.socketPath)
+      try:
+         while not self.stopped:
+            server.handle_request()
+      finally:
+         server.server_close()
+         os.remove(self.socketPath)
+
+   def handleRequest(self, request):
+      """ Run a request, printing its output.  Returns the exit status. """
+      project = self.project
+      self.requests += 1
+      if (request.get("config_file", None) != project.confFile or
+          request.get("cwd", None) != os.getcwd()):
+         return None      # Not ours, the client builds it itself
+
+      command = request.get("command", "build")
+      if command == "stop":
+         print "Stopping daemon"
+         self.stopped = True
+         return 0
+      if command == "status":
+         self.printStatus()
+         return 0
+
+      with project.statCache.cycle():
+         return self.runCommand(command, request)
+
+   def runCommand(self, command, request):
+      """ Run a build or clobber request, inside a stat cycle. """
+      project = self.project
+      conf_mtime = project.statCache.stat(project.confFile).st_mtime
+      if conf_mtime != self.confMtime:
+         print "Changed conf detected, reloading..."
+         self.confMtime = conf_mtime
+         project.loadConfig(project.confFile)
+
+      build_ids = project.getBuildIds(request.get("build", "all"))
+      project.jsWorkers       = request.get("workers", None)
+      project.buildWorkers    = request.get("build_workers", 0)
+      project.changeDetection = request.get("change_detection", None)
+      project.cacheDir        = request.get("cache_dir", None)
+      if command == "clobber":
+         project.clobber(build_ids)
+         return 0
+
+      project.updateFileGroups(build_ids)
+      def recordBuild(span):
+         if span.name == "build":
+            self.lastBuilds[span.args["build"]] = (span.startTime, span.wallTime)
+      project.profiler.addHook(recordBuild)
+      try:
+         project.runBuild(build_ids)
+      finally:
+         project.profiler.removeHook(recordBuild)
+      print "Done"
+      return 0
+
+   def printStatus(self):
+      print "Daemon for %s (pid %d)" % (self.project.confFile, os.getpid())
+      print "Up %d seconds, %d requests" % (time.time() - self.startTime, self.requests)
+      for build in self.project.builds:
+         line = "Build %s: %d files" % (build.key, len(self.project.getFullFileList(build.key)))
+         if self.lastBuilds.has_key(build.key):
+            (start_time, seconds) = self.lastBuilds[build.key]
+            line += ", last built %s in %.3fs" % (
+               datetime.datetime.fromtimestamp(start_time).strftime("%H:%M:%S"), seconds)
+         print line
+      print self.project.statCache.summary()
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+   """ Runs one request of self.server.buildDaemon, sending its output back. """
+   def handle(self):
+      try:
+         request = json.loads(self.rfile.readline())
+      except ValueError:
+         return
+
+      old_stdout = sys.stdout
+      sys.stdout = DaemonOutput(self.wfile)
+      try:
+         try:
+            status = self.server.buildDaemon.handleRequest(request)
+         except (SystemExit, ValueError, RuntimeError, EnvironmentError), e:
+            print "Error: %s" % e
+            status = 1
+         except Exception:
+            import traceback
+            traceback.print_exc(file = sys.stdout)
+            status = 1
+         sys.stdout.flush()
+         self.wfile.write(json.dumps({"status" : status}) + "\n")
+      except socket.error:
+         pass       # The client went away
+      finally:
+         sys.stdout = old_stdout
+
+
+class DaemonOutput(object):
+   """ File like object sending what is written to it a line at a time. """
+   def __init__(self, outFile):
+      self.outFile = outFile
+      self.buffer  = ""
+      self.lock    = threading.Lock()   # Builds and their threads write at once
+
+   def write(self, data):
+      self.lock.acquire()
+      try:
+         self.buffer += data
+         if "\n" in self.buffer:
+            (lines, self.buffer) = self.buffer.rsplit("\n", 1)
+            for line in lines.split("\n"):
+               self.outFile.write(json.dumps({"output" : line}) + "\n")
+            self.outFile.flush()
+      finally:
+         self.lock.release()
+
+   def flush(self):
+      if self.buffer:
+         self.write("\n")
+
+
+class DaemonClient(object):
+   """ Sends requests to a BuildDaemon and prints what comes back. """
+   def __init__(self, socketPath):
+      self.socketPath = socketPath
+
+   @staticmethod
+   def socketPath(confFile):
+      (conf_dir, conf_name) = os.path.split(os.path.abspath(confFile))
+      return pj(conf_dir, ".%s.p5_daemon" % conf_name)
+
+   def connect(self):
+      """ Return a socket connected to the daemon, or None if none is running. """
+      if not hasattr(socket, "AF_UNIX") or not os.path.exists(self.socketPath):
+         return None
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+         sock.connect(self.socketPath)
+      except socket.error:
+         sock.close()
+         return None
+      return sock
+
+   def run(self, request):
+      """
+      Send the request, printing its output as it arrives.  Returns the exit
+      status, or None if there is no daemon or it could not take the request.
+      """
+      sock = self.connect()
+      if sock is None:
+         return None
+      try:
+         sock.sendall(json.dumps(request) + "\n")
+         for line in sock.makefile('r'):
+            reply = json.loads(line)
+            if reply.has_key("output"):
+               print reply["output"]
+            else:
+               return reply["status"]
+      finally:
+         sock.close()
+      return None
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# The umask can only be read by setting it, which is not safe once other
+# threads create files, so it is read once here
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+_libc = []
+
+def loadLibc():
+   """ Return the C library loaded with ctypes, or None if we can't find it. """
+   if not _libc:
+      libc = None
+      libc_name = ctypes.util.find_library("c")
+      if libc_name is not None:
+         try:
+            libc = ctypes.CDLL(libc_name, use_errno = True)
+         except OSError:
+            pass
+      if libc is not None and hasattr(libc, "copy_file_range"):
+         libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                          ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+         libc.copy_file_range.restype = ctypes.c_ssize_t
+      if libc is not None and hasattr(libc, "sendfile"):
+         libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+         libc.sendfile.restype = ctypes.c_ssize_t
+      _libc.append(libc)
+   return _libc[0]
+
+
+def copyFileData(inFile, outFile):
+   """
+   Copy the contents of the open file inFile to outFile.  Uses the kernel
+   copy_file_range or sendfile calls (through ctypes, which also releases the
+   GIL) when available, otherwise a plain read/write loop.
+   """
+   libc = loadLibc()
+   in_fd  = inFile.fileno()
+   out_fd = outFile.fileno()
+   for call in ("copy_file_range", "sendfile"):
+      if libc is None or not hasattr(libc, call):
+         continue
+      total = 0
+      while True:
+         if call == "copy_file_range":
+            n = libc.copy_file_range(in_fd, None, out_fd, None, COPY_CHUNK_SIZE * 8, 0)
+         else:
+            n = libc.sendfile(out_fd, in_fd, None, COPY_CHUNK_SIZE * 8)
+         if n <= 0:
+            break
+         total += n
+      if n == 0:
+         return
+      err = ctypes.get_errno()
+      if total > 0 or err not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                  errno.EOPNOTSUPP, errno.EBADF):
+         raise OSError(err, os.strerror(err))
+   shutil.copyfileobj(inFile, outFile, COPY_CHUNK_SIZE)
+
+
+def fingerprintName(fname, digest, length):
+   """
+   Return fname with the first length characters of digest put in front of
+   the extension.  ex: fingerprintName("js/app.js", "3f9a1c...", 6) == "js/app.3f9a1c.js"
+   """
+   (base, ext) = os.path.splitext(fname)
+   return "%s.%s%s" % (base, digest[:length], ext)
+
+
+def writeFileIfChanged(fname, data):
+   """
+   Write data to fname unless it already holds exactly that.  The file is
+   replaced atomically.  Returns True if the file was written.
+   """
+   try:
+      if os.path.getsize(fname) == len(data) and open(fname, 'rb').read() == data:
+         return False
+   except (IOError, OSError):
+      pass
+
+   dir_name = os.path.dirname(fname)
+   if dir_name and not os.path.exists(dir_name):
+      os.makedirs(dir_name)
+   (fd, tmp_fname) = makeTempFile(fname)
+   out_file = os.fdopen(fd, 'wb')
+   try:
+      out_file.write(data)
+   finally:
+      out_file.close()
+   replaceFile(tmp_fname, fname)
+   return True
+
+
+def fileHash(fname):
+   """ Return the sha1 hex digest of the contents of fname. """
+   hasher = hashlib.sha1()
+   in_file = open(fname, 'rb')
+   try:
+      for chunk in iter(lambda: in_file.read(COPY_CHUNK_SIZE), ""):
+         hasher.update(chunk)
+   finally:
+      in_file.close()
+   return hasher.hexdigest()
+
+
+def makeTempFile(targetFname):
+   """
+   Create a temp file in the directory of targetFname, to be moved onto it
+   with replaceFile.  Returns (fd, temp file name).  Unlike plain mkstemp
+   the file gets the permissions a normally created file would have.
+   """
+   target_dir = os.path.dirname(os.path.abspath(targetFname))
+   (fd, tmp_fname) = tempfile.mkstemp(dir = target_dir, prefix = ".tmp")
+   os.chmod(tmp_fname, 0666 & ~UMASK)
+   return (fd, tmp_fname)
+
+
+def replaceFile(srcFname, targetFname):
+   """
+   Move srcFname over targetFname.  This is atomic where the platform
+   supports it (posix), otherwise the target is removed first.
+   """
+   try:
+      os.rename(srcFname, targetFname)
+   except OSError:
+      if not os.path.exists(targetFname):
+         raise
+      os.remove(targetFname)
+      os.rename(srcFname, targetFname)
+
+
+class InotifyWatcher(object):
+   """
+   Waits for changes in a set of directories using the Linux inotify API
+   (through ctypes, so there is nothing extra to install).
+
+   inotify watches are not recursive, so the caller passes every directory
+   it cares about to watchDirs.  Calling it again adds any new directories.
+   """
+   IN_MODIFY      = 0x00000002
+   IN_ATTRIB      = 0x00000004
+   IN_CLOSE_WRITE = 0x00000008
+   IN_MOVED_FROM  = 0x00000040
+   IN_MOVED_TO    = 0x00000080
+   IN_CREATE      = 0x00000100
+   IN_DELETE      = 0x00000200
+   IN_DELETE_SELF = 0x00000400
+   IN_MOVE_SELF   = 0x00000800
+   IN_IGNORED     = 0x00008000
+   IN_ONLYDIR     = 0x01000000
+   IN_NONBLOCK    = 0x00000800
+   IN_CLOEXEC     = 0x00080000
+
+   WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+   EVENT_HEADER = struct.Struct("iIII")   # wd, mask, cookie, len
+
+   def __init__(self):
+      libc = loadLibc()
+      if libc is None:
+         raise OSError(errno.ENOSYS, "libc not found")
+      if not hasattr(libc, "inotify_init1"):
+         raise OSError(errno.ENOSYS, "inotify not supported")
+      self._addWatch = libc.inotify_add_watch
+      self._addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+      self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+      if self.fd < 0:
+         err = ctypes.get_errno()
+         raise OSError(err, os.strerror(err))
+      self.dirs = {}      # Map from watched directory to watch descriptor
+      self.watches = {}   # Map from watch descriptor to directory
+
+   @staticmethod
+   def create():
+      """ Return a new watcher, or None if inotify is not available here. """
+      if not sys.platform.startswith("linux"):
+         return None
+      try:
+         return InotifyWatcher()
+      except OSError, e:
+         print "inotify not available (%s), polling for changes" % e
+         return None
+
+   def watchDirs(self, dirs):
+      """ Start watching each directory in dirs that we don't already watch. """
+      for dir_name in dirs:
+         if self.dirs.has_key(dir_name) or not os.path.isdir(dir_name):
+            continue
+         wd = self._addWatch(self.fd, dir_name, self.WATCH_MASK)
+         if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):   # Removed since we looked
+               continue
+            raise OSError(err, "%s: %s" % (os.strerror(err), dir_name))
+         self.dirs[dir_name] = wd
+         self.watches[wd] = dir_name
+
+   def wait(self, timeout = None, settle = 0.02):
+      """
+      Block until something changes in a watched directory (or timeout seconds
+      pass).  Once the first event arrives we wait settle seconds more to gather
+      up the rest of a burst (editors often write a file in several steps).
+
+      @returns: set of the paths that changed.
+      """
+      changed = set()
+      (readable, w, x) = select.select([self.fd], [], [], timeout)
+      if readable:
+         time.sleep(settle)
+         changed = self.readEvents()
+      return changed
+
+   def readEvents(self):
+      changed = set()
+      while True:
+         try:
+            data = os.read(self.fd, 64 * 1024)
+         except OSError, e:
+            if e.errno == errno.EAGAIN:
+               break
+            raise
+         offset = 0
+         while offset < len(data):
+            (wd, mask, cookie, name_len) = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip("\0")
+            offset += name_len
+
+            dir_name = self.watches.get(wd, None)
+            if dir_name is None:
+               continue
+            changed.add(pj(dir_name, name) if name else dir_name)
+            if mask & self.IN_IGNORED:   # Watch removed (directory deleted)
+               del self.watches[wd]
+               del self.dirs[dir_name]
+      return changed
+
+   def close(self):
+      os.close(self.fd)
+      self.dirs = {}
+      self.watches = {}
+
+
+IGNORE_DIRS = [".svn", ".sass-cache", ".p5_cache"]
+
+class StatCache(object):
+   """
+   Stats of the paths looked at during one cycle of work, so each path is
+   stat'ed once however many places ask about it.  A cycle is a build, or in
+   monitor mode a check for changes and the build it starts.
+
+   Results are only kept while a cycle is open (see cycle()), outside one
+   every lookup goes to the file system.  Opening the outermost cycle starts a
+   new generation with nothing cached, invalidate() does the same inside one,
+   and forget() drops a path we just rewrote.  Missing paths are cached too.
+
+   @ivar generation: Number of the current generation.
+   @ivar hits: Lookups answered from the cache.
+   @ivar misses: Lookups that had to stat.
+   """
+   def __init__(self):
+      self.generation = 0
+      self.hits   = 0
+      self.misses = 0
+      self.depth  = 0      # Number of open cycles
+      self.stats  = {}     # Map from normalized path to its stat, None if missing
+      self.lock   = threading.Lock()
+
+   @contextlib.contextmanager
+   def cycle(self):
+      """ Keep stats for the duration of a with block, cycles may nest. """
+      with self.lock:
+         if self.depth == 0:
+            self.newGeneration()
+         self.depth += 1
+      try:
+         yield self
+      finally:
+         with self.lock:
+            self.depth -= 1
+            if self.depth == 0:
+               self.stats = {}
+
+   def invalidate(self):
+      """ Forget everything, the next lookups stat again. """
+      with self.lock:
+         self.newGeneration()
+
+   def newGeneration(self):
+      self.generation += 1
+      self.stats = {}
+
+   def forget(self, path):
+      with self.lock:
+         self.stats.pop(os.path.normpath(path), None)
+
+   def lookup(self, path):
+      """ Return the stat of path, or None if it does not exist. """
+      path = os.path.normpath(path)
+      with self.lock:
+         if self.stats.has_key(path):
+            self.hits += 1
+            return self.stats[path]
+         self.misses += 1
+         generation = self.generation
+      try:
+         stats = os.stat(path)
+      except OSError:
+         stats = None
+      with self.lock:
+         if self.depth and self.generation == generation:
+            self.stats[path] = stats
+      return stats
+
+   def stat(self, path):
+      """ Like os.stat, raises OSError if path does not exist. """
+      stats = self.lookup(path)
+      if stats is None:
+         raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+      return stats
+
+   def exists(self, path):
+      return self.lookup(path) is not None
+
+   def isdir(self, path):
+      stats = self.lookup(path)
+      return stats is not None and stat.S_ISDIR(stats.st_mode)
+
+   def isfile(self, path):
+      stats = self.lookup(path)
+      return stats is not None and stat.S_ISREG(stats.st_mode)
+
+   def summary(self):
+      total = self.hits + self.misses
+      return "Stat cache: %d lookups, %d hits, %d misses (%.0f%% hits)" % (
+         total, self.hits, self.misses, total and 100.0 * self.hits / total)
+
+
+class DirScanner(object):
+   """
+   Finds the files matching a set of (root, pattern) matchers.
+
+   Each distinct root is walked once for all of its patterns, and directory
+   listings are kept between scans keyed by the directory mtime, so a later
+   scan only stats the directories and re-lists the ones that changed.
+   Walk order and results are the same as matchFiles using os.walk.
+   """
+   # Listings taken less than this many seconds after the directory changed
+   # are not trusted on the next scan, the mtime may not have ticked over for
+   # a change made right after we listed it.
+   RACY_SECONDS = 1.0
+
+   def __init__(self, statCache = None):
+      self.listings = {}   # Map from dir path to (mtime, trusted, listing)
+      self.stats    = statCache or StatCache()
+
+   def scan(self, matchers, ignoreDirs = IGNORE_DIRS):
+      """
+      @param matchers: list of (root dir, pattern) tuples.
+      @returns: Map from each (root dir, pattern) to the list of matching files.
+      """
+      root_patterns = {}
+      for (root_dir, pattern) in matchers:
+         patterns = root_patterns.setdefault(root_dir, [])
+         if pattern not in patterns:
+            patterns.append(pattern)
+
+      results = {}
+      for (root_dir, patterns) in root_patterns.iteritems():
+         matches = dict([(pattern, []) for pattern in patterns])
+         for (dir_name, dirnames, filenames) in self.walk(root_dir, ignoreDirs):
+            for pattern in patterns:
+               for filename in fnmatch.filter(filenames, pattern):
+                  matches[pattern].append(os.path.normpath(pj(dir_name, filename)))
+         for pattern in patterns:
+            results[(root_dir, pattern)] = matches[pattern]
+      return results
+
+   def walk(self, rootDir, ignoreDirs = IGNORE_DIRS):
+      """
+      Like os.walk (top down, not following links) but using cached listings.
+      Yields (dir path, subdir names, file names).
+      """
+      listing = self.listDir(rootDir)
+      if listing is None:
+         return
+      (dirnames, filenames, linknames) = listing
+      dirnames = [d for d in dirnames if d not in ignoreDirs]
+      yield (rootDir, dirnames, filenames)
+      for dirname in dirnames:
+         if dirname not in linknames:
+            for result in self.walk(pj(rootDir, dirname), ignoreDirs):
+               yield result
+
+   def walkDirs(self, rootDir, ignoreDirs = IGNORE_DIRS):
+      """ Yield the path of every directory under rootDir (including it). """
+      for (dir_name, dirnames, filenames) in self.walk(rootDir, ignoreDirs):
+         yield dir_name
+
+   def dirMtimes(self, rootDirs, ignoreDirs = IGNORE_DIRS):
+      """
+      Return map from each directory the last scan of rootDirs listed to its
+      mtime then (None for roots that did not exist).  Returns None if one of
+      the listings is too recent to trust (see RACY_SECONDS).
+      """
+      mtimes  = {}
+      pending = list(rootDirs)
+      while pending:
+         dir_name = pending.pop()
+         cached = self.listings.get(dir_name, None)
+         if cached is None:
+            if dir_name not in rootDirs or os.path.exists(dir_name):
+               return None
+            mtimes[dir_name] = None
+            continue
+         (mtime, trusted, (dirnames, filenames, linknames)) = cached
+         if not trusted:
+            return None
+         mtimes[dir_name] = mtime
+         pending.extend([pj(dir_name, d) for d in dirnames
+                         if d not in ignoreDirs and d not in linknames])
+      return mtimes
+
+   def listDir(self, dirName):
+      """
+      Return (subdir names, file names, names of subdirs that are links) for
+      dirName, or None if it can't be listed.
+      """
+      try:
+         mtime = self.stats.stat(dirName).st_mtime
+      except OSError:
+         self.listings.pop(dirName, None)
+         return None
+
+      cached = self.listings.get(dirName, None)
+      if cached is not None and cached[0] == mtime and cached[1]:
+         return cached[2]
+
+      listing = self.readDir(dirName)
+      if listing is not None:
+         trusted = (time.time() - mtime) > self.RACY_SECONDS
+         self.listings[dirName] = (mtime, trusted, listing)
+      return listing
+
+   @staticmethod
+   def readDir(dirName):
+      dirnames  = []
+      filenames = []
+      linknames = set()
+      try:
+         if scandir is not None:
+            for entry in scandir(dirName):
+               if entry.is_dir():
+                  dirnames.append(entry.name)
+                  if entry.is_symlink():
+                     linknames.add(entry.name)
+               else:
+                  filenames.append(entry.name)
+         else:
+            for name in os.listdir(dirName):
+               path = pj(dirName, name)
+               if os.path.isdir(path):
+                  dirnames.append(name)
+                  if os.path.islink(path):
+                     linknames.add(name)
+               else:
+                  filenames.append(name)
+      except OSError:
+         return None
+      return (dirnames, filenames, linknames)
+
+
+def matchFiles(rootDir, pattern, ignoreDirs = IGNORE_DIRS):
    """
    ex: matchFiles("/home/allenb", "*.js")
    """
-   matches = []
-   for root, dirnames, filenames in os.walk(rootDir):
-      for bad_dir_name in ignoreDirs:
-         if bad_dir_name in dirnames:
-            dirnames.remove(bad_dir_name)
-      for filename in fnmatch.filter(filenames, pattern):
-         fname = os.path.normpath(pj(root, filename))
-         matches.append(fname)
-   return matches
+   return DirScanner().scan([(rootDir, pattern)], ignoreDirs)[(rootDir, pattern)]
 
 
 def generateBuildNumber(dir = None):
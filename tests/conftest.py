@@ -0,0 +1,5 @@
+import sys
+
+# The packager is python 2 code, there is nothing to collect under python 3
+if sys.version_info[0] >= 3:
+   collect_ignore_glob = ["test_*.py"]
@@ -0,0 +1,14 @@
+/* Leading block comment */
+/*! Preserved-looking license comment */
+var a = 1; // trailing line comment
+var b = /* inline */ 2;
+/*
+ * Multi line
+ * block comment
+ */
+function f(x) { // comment after brace
+   return x /* between */ + 1;
+}
+var c = a /* no space */+/* around */b;
+var d = a - -b, e = a + +b, g = a - --b, h = a + ++b;
+//# sourceMappingURL=app.js.map
@@ -0,0 +1,16 @@
+// Line continuations and automatic semicolon insertion
+var s = "a long \
+string";
+var t = 'another \
+one';
+var x = 1
+var y = 2
+x
+++y
+return
+{ a: 1 }
+var z = a
+(function () {})()
+var w = [1,
+         2,
+         3]
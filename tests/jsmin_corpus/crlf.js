@@ -0,0 +1,10 @@
+var a = 1;
+var b = 2;
+// comment
+function f() {
+   return a
+}
+/* block
+ comment */
+var c = "x";
+var d = 4;
\ No newline at end of file
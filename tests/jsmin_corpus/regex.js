@@ -0,0 +1,11 @@
+// Regex literals next to division
+var r1 = /ab+c/gi;
+var r2 = x / y / z;
+var r3 = (a) / 2;
+var r4 = [/[/]/, /\//, /[\]/]/];
+var r5 = str.replace(/"/g, '\\"').split(/,\s*/);
+var r6 = a++ / 2, r7 = b-- / 3;
+if (/^\s+$/.test(s)) { r = !/x/.test(t); }
+return /foo/;
+var r8 = typeof /x/ === "object" ? 1 : i / 2 / 3;
+var r9 = {re: /a|b/, d: 4 / 2};
@@ -0,0 +1,8 @@
+// String literals with quotes, escapes and comment look-alikes
+var a = "double \"quoted\" string";
+var b = 'single \'quoted\' string';
+var c = "has // no comment" + 'nor /* this */';
+var d = "escaped backslash \\" + 'and \\' ;
+var e = "unicode \u00e9 and hex \x41";
+var f = "slashes / and /regex/ looking";
+var g = a + "" + '' + b;
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+#
+# Differential tests of the jsmin engines: the fast engine has to give
+# exactly what the classic port of jsmin.c gives, for every file of the
+# corpus in jsmin_corpus/.
+#
+#   python -m unittest discover tests
+
+import glob
+import os
+import sys
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, os.pardir))
+import jsmin
+
+CORPUS = sorted(glob.glob(os.path.join(TEST_DIR, "jsmin_corpus", "*.js")))
+
+
+class EngineCompareTest(unittest.TestCase):
+   def testCorpusExists(self):
+      self.assertTrue(CORPUS)
+
+   def testEnginesMatch(self):
+      for fname in CORPUS:
+         src = open(fname, 'rb').read()
+         self.assertEqual(jsmin.jsmin(src, "fast"), jsmin.jsmin(src, "classic"),
+                          "engines differ on %s" % os.path.basename(fname))
+
+   def testCompareEngines(self):
+      old_stdout = sys.stdout
+      sys.stdout = open(os.devnull, 'w')
+      try:
+         mismatches = jsmin.compareEngines(CORPUS)
+      finally:
+         sys.stdout.close()
+         sys.stdout = old_stdout
+      self.assertEqual(mismatches, 0)
+
+
+if __name__ == '__main__':
+   unittest.main()
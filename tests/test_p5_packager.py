@@ -0,0 +1,232 @@
+#!/usr/bin/python
+#
+# Tests of p5_packager builds, run with:
+#
+#   python -m unittest discover tests
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import p5_packager
+pj = os.path.join
+
+
+class Quiet(object):
+   """ Swallows the output of the packager. """
+   def write(self, data):
+      pass
+
+   def flush(self):
+      pass
+
+
+class BuildTestCase(unittest.TestCase):
+   """ Runs builds of a project written to a temp directory. """
+   def setUp(self):
+      self.oldCwd = os.getcwd()
+      self.projectDir = tempfile.mkdtemp(prefix = "p5_test")
+      os.chdir(self.projectDir)
+      self.oldStdout = sys.stdout
+      sys.stdout = Quiet()
+
+   def tearDown(self):
+      sys.stdout = self.oldStdout
+      os.chdir(self.oldCwd)
+      shutil.rmtree(self.projectDir)
+
+   def writeFile(self, fname, data):
+      dir_name = os.path.dirname(fname)
+      if dir_name and not os.path.exists(dir_name):
+         os.makedirs(dir_name)
+      open(fname, 'w').write(data)
+
+   def editFile(self, fname, data):
+      """ Rewrite fname making sure its mtime changes. """
+      old_mtime = os.stat(fname).st_mtime
+      self.writeFile(fname, data)
+      os.utime(fname, (old_mtime + 10, old_mtime + 10))
+
+   def loadProject(self, config):
+      self.writeFile("build.cfg", json.dumps(config))
+      proj = p5_packager.Project()
+      proj.usePlan = False
+      proj.loadConfig(os.path.abspath("build.cfg"))
+      return proj
+
+
+class IncrementalFingerprintTest(BuildTestCase):
+   def setUp(self):
+      BuildTestCase.setUp(self)
+      self.writeFile(pj("js", "a.js"), "var a = 1;\n")
+      self.writeFile("index.html", "{% js_files %}\n<!-- {% build_id %} -->\n")
+      self.proj = self.loadProject(
+         {"packages" : [{"id"  : "app",
+                         "dev" : {"js_files"    : [{"root" : "js", "pattern" : "*.js"}],
+                                  "subst_files" : ["index.html"]}}],
+          "builds"   : {"dev" : {"target_dir" : "out", "fingerprint" : True}}})
+
+   def scriptNames(self):
+      html = open(pj("out", "index.html"), 'r').read()
+      return re.findall(r'src="([^"]+)"', html)
+
+   def testEditRenamesOutput(self):
+      self.proj.runBuild(["dev"])
+      (old_name,) = self.scriptNames()
+      self.assertTrue(os.path.exists(pj("out", old_name)))
+
+      self.editFile(pj("js", "a.js"), "var a = 2;\n")
+      self.proj.runBuild(["dev"], set([pj("js", "a.js")]))
+      (new_name,) = self.scriptNames()
+      self.assertNotEqual(new_name, old_name)
+      self.assertTrue(os.path.exists(pj("out", new_name)))
+
+   def testEditUpdatesBuildId(self):
+      self.proj.runBuild(["dev"])
+      old_html = open(pj("out", "index.html"), 'r').read()
+
+      self.editFile(pj("js", "a.js"), "var a = 2;\n")
+      self.proj.runBuild(["dev"], set([pj("js", "a.js")]))
+      new_html = open(pj("out", "index.html"), 'r').read()
+      self.assertNotEqual(new_html.splitlines()[-1], old_html.splitlines()[-1])
+
+
+
+class IncrementalBuildTest(BuildTestCase):
+   OLD_TIME = 1000000000
+
+   def setUp(self):
+      BuildTestCase.setUp(self)
+      self.writeFile(pj("js", "a.js"), "var a = 1;\n")
+      self.writeFile(pj("js", "b.js"), "var b = 1;\n")
+      self.writeFile(pj("css", "a.css"), "a { color: red; }\n")
+      self.writeFile(pj("img", "x.png"), "PNG")
+      self.writeFile("index.html", "{% js_files %}\n{% css_files %}\n")
+      self.proj = self.loadProject(
+         {"packages" : [{"id"  : "app",
+                         "dev" : {"js_files"    : [{"root" : "js", "pattern" : "*.js"}],
+                                  "css_files"   : [pj("css", "a.css")],
+                                  "images"      : [pj("img", "x.png")],
+                                  "subst_files" : ["index.html"]}}],
+          "builds"   : {"dev" : {"target_dir"      : "out",
+                                 "js_compression"  : {"level" : 2, "filename" : "app.min.js"},
+                                 "css_compression" : {"level" : 2, "filename" : "app.min.css"}}}})
+      self.proj.runBuild(["dev"])
+      for (dir_name, dirnames, filenames) in os.walk("out"):
+         for filename in filenames:
+            os.utime(pj(dir_name, filename), (self.OLD_TIME, self.OLD_TIME))
+
+   def writtenOutputs(self):
+      """ Return the files in the target dir written since setUp. """
+      written = []
+      for (dir_name, dirnames, filenames) in os.walk("out"):
+         for filename in filenames:
+            fname = pj(dir_name, filename)
+            if os.stat(fname).st_mtime != self.OLD_TIME:
+               written.append(os.path.relpath(fname, "out"))
+      return sorted(written)
+
+   def testNoChangesWritesNothing(self):
+      self.proj.runBuild(["dev"])
+      self.assertEqual(self.writtenOutputs(), [])
+      self.proj.runBuild(["dev"], set())
+      self.assertEqual(self.writtenOutputs(), [])
+
+   def testEditRebuildsDependents(self):
+      self.editFile(pj("css", "a.css"), "a { color: blue; }\n")
+      self.proj.runBuild(["dev"])
+      self.assertEqual(self.writtenOutputs(), [p5_packager.BuildManifest.FILENAME,
+                                               "app.min.css"])
+      self.assertTrue("blue" in open(pj("out", "app.min.css"), 'r').read())
+
+   def testChangedFilesRebuildsDependents(self):
+      self.editFile(pj("img", "x.png"), "PNG2")
+      self.proj.runBuild(["dev"], set([pj("img", "x.png")]))
+      self.assertEqual(self.writtenOutputs(), [p5_packager.BuildManifest.FILENAME,
+                                               pj("img", "x.png")])
+      self.assertEqual(open(pj("out", "img", "x.png"), 'r').read(), "PNG2")
+
+
+class MinifyCacheTest(BuildTestCase):
+   def setUp(self):
+      BuildTestCase.setUp(self)
+      self.writeFile(pj("js", "a.js"), "var a = 1;   // one\n")
+      self.writeFile(pj("js", "b.js"), "var b = 2;   // two\n")
+      self.jsFiles = [pj("js", "a.js"), pj("js", "b.js")]
+      self.cache   = p5_packager.MinifyCache(pj(self.projectDir, "cache"), 1024 * 1024)
+      self.version = p5_packager.Project.minifierVersion(2)
+
+   def compress(self):
+      p5_packager.Project.compressJsFiles(2, self.jsFiles, "app.js", cache = self.cache)
+      return open("app.js", 'r').read()
+
+   def keys(self):
+      keys = [self.cache.makeKey(open(js_file, 'r').read(), 2, self.version)
+              for js_file in self.jsFiles]
+      return keys + [self.cache.makeKey("\n".join(keys), 2, "bundle:" + self.version)]
+
+   def testDamagedEntryRebuilt(self):
+      expected = self.compress()
+      for key in self.keys():
+         path = self.cache.entryPath(key)
+         data = open(path, 'rb').read()
+         open(path, 'wb').write(data[:-2] + "X" + data[-1])
+
+      os.remove("app.js")
+      self.assertEqual(self.compress(), expected)
+      for key in self.keys():
+         self.assertNotEqual(self.cache.get(key), None)
+
+   def testEditWhileMinifyingNotCached(self):
+      old_keys = self.keys()
+      minify = p5_packager._minifyJsWorker
+      def editFirst(args):
+         if args[1] == pj("js", "a.js"):
+            self.writeFile(pj("js", "a.js"), "var a = 3;\n")
+         return minify(args)
+      p5_packager._minifyJsWorker = editFirst
+      try:
+         self.compress()
+      finally:
+         p5_packager._minifyJsWorker = minify
+
+      self.assertFalse(self.cache.has(old_keys[0]))
+      self.assertFalse(self.cache.has(old_keys[2]))
+      self.assertTrue(self.cache.has(old_keys[1]))
+      self.assertTrue("a=3" in self.compress())
+      for key in self.keys():
+         self.assertTrue(self.cache.has(key))
+
+
+   def testPruneEvictsLeastRecentlyUsed(self):
+      for (i, key) in enumerate(["aa01", "bb02", "cc03"]):
+         self.cache.put(key, "x" * 1000)
+         os.utime(self.cache.entryPath(key), (1000000000 + i, 1000000000 + i))
+      self.cache.get("aa01")     # Used last, so it stays
+      self.cache.maxBytes = 2500
+      self.cache.prune(force = True)
+      self.assertEqual([self.cache.has(key) for key in ["aa01", "bb02", "cc03"]],
+                       [True, False, True])
+
+   def testCssCachesTheTextItKeyed(self):
+      import cssmin
+      self.writeFile(pj("css", "a.css"), "a { color: red; }\n")
+      version = "cssmin-%s:%s:%s" % (cssmin.VERSION, pj("css", "a.css"), "app.css")
+      old_key = self.cache.makeKey(open(pj("css", "a.css"), 'r').read(), 2, version)
+      get = self.cache.get
+      def editFirst(key):
+         self.writeFile(pj("css", "a.css"), "a { color: blue; }\n")
+         return get(key)
+      self.cache.get = editFirst
+      p5_packager.Project.compressCssFiles(2, [pj("css", "a.css")], "app.css", self.cache)
+      del self.cache.get
+      self.assertTrue("red" in self.cache.get(old_key))
+
+
+if __name__ == '__main__':
+   unittest.main()